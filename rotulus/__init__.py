@@ -3,7 +3,12 @@ from . import database
 from . import seeder
 from . import hashid
 from . import record
+from . import reader
+from . import checkpoint
+from . import stats
 from . import swell
+from . import binary_copy
+from . import dedup
 
 __all__ = [
     'query',
@@ -11,5 +16,10 @@ __all__ = [
     'seeder',
     'hashid',
     'record',
+    'reader',
+    'checkpoint',
+    'stats',
     'swell',
+    'binary_copy',
+    'dedup',
 ]
\ No newline at end of file
@@ -0,0 +1,161 @@
+import argparse
+import asyncio
+import io
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+from rotulus.binary_copy import BinaryCopy
+from rotulus.database import async_db_connect
+from rotulus.reader import split_lines
+from rotulus.record import Record
+from rotulus.seeder import create_staging_table, parse_block, parse_lines, parse_options
+
+
+def sample_block(nb_lines, spliter=b':'):
+    """Block of random email<spliter>password lines"""
+    generator = random.Random(0)
+    letters = string.ascii_lowercase + string.digits
+    lines = []
+    for _ in range(nb_lines):
+        username = ''.join(generator.choices(letters, k=generator.randint(4, 12)))
+        domain = generator.choice(['gmail.com', 'mail.ru', 'yahoo.fr', 'example.org'])
+        password = ''.join(generator.choices(letters, k=generator.randint(6, 14)))
+        lines.append('{}@{}'.format(username, domain).encode() + spliter + password.encode())
+    return b'\n'.join(lines) + b'\n'
+
+
+def parse_objects(options, block):
+    records, errors = parse_lines(options, split_lines(block))
+    return [Record.from_tuple(record) for record in records], errors
+
+
+def parse_tuples(options, block):
+    return parse_lines(options, split_lines(block))
+
+
+RECORD_PARSERS = {
+    'objects': parse_objects,
+    'tuples': parse_tuples,
+    'block': parse_block,
+}
+
+
+def measure(function, *args, repeat=3):
+    """Returns the best time of repeat calls and the memory peak of one call"""
+    seconds = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(*args)
+        seconds = min(seconds, time.perf_counter() - started)
+    tracemalloc.start()
+    result = function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return seconds, peak
+
+
+def bench_records(nb_lines):
+    print('[*] Parsing {} lines'.format(nb_lines))
+    options = parse_options(argparse.Namespace(spliter=b':', hash=False, cipher=None, format='combo'))
+    block = sample_block(nb_lines)
+    for name, parser in RECORD_PARSERS.items():
+        seconds, peak = measure(parser, options, block)
+        print('[+] {:<8} {:8.0f} ns/line {:8.1f} bytes/line'.format(
+            name, seconds / nb_lines * 1e9, peak / nb_lines))
+
+
+def staging_records(nb_lines):
+    options = parse_options(argparse.Namespace(spliter=b':', hash=False, cipher=None, format='combo'))
+    records, _ = parse_block(options, sample_block(nb_lines))
+    return [(username, len(domain), password) for username, domain, password in records]
+
+
+def encode_text(records):
+    return b''.join(b'\\\\x' + username.hex().encode() + b'\t' + str(domain_id).encode() + b'\t\\\\x'
+                    + secret.hex().encode() + b'\n' for username, domain_id, secret in records)
+
+
+async def collect(chunks):
+    return [bytes(chunk) async for chunk in chunks]
+
+
+def encode_binary(records):
+    return asyncio.get_event_loop().run_until_complete(collect(BinaryCopy().staging_rows(records)))
+
+
+async def copy_text(connection, table, records):
+    await connection.copy_to_table(table, source=io.BytesIO(encode_text(records)),
+                                   columns=['username', 'domain_id', 'secret'])
+
+
+async def copy_tuples(connection, table, records):
+    await connection.copy_records_to_table(table, records=records,
+                                           columns=['username', 'domain_id', 'secret'])
+
+
+async def copy_binary(connection, table, records):
+    await connection.copy_to_table(table, source=BinaryCopy().staging_rows(records),
+                                   columns=['username', 'domain_id', 'secret'], format='binary')
+
+
+COPY_METHODS = {
+    'text': copy_text,
+    'tuples': copy_tuples,
+    'binary': copy_binary,
+}
+
+
+async def bench_copy_to_db(records, repeat=3):
+    connection = await async_db_connect()
+    if not connection:
+        return
+    for name, method in COPY_METHODS.items():
+        seconds = float('inf')
+        for _ in range(repeat):
+            async with connection.transaction():
+                table = await create_staging_table(connection, 'bytea')
+                started = time.perf_counter()
+                await method(connection, table, records)
+                seconds = min(seconds, time.perf_counter() - started)
+        print('[+] COPY {:<8} {:8.0f} ns/row'.format(name, seconds / len(records) * 1e9))
+    await connection.close()
+
+
+def bench_copy(nb_lines):
+    records = staging_records(nb_lines)
+    print('[*] Encoding {} staging rows'.format(len(records)))
+    for name, encoder in [('text', encode_text), ('binary', encode_binary)]:
+        seconds, peak = measure(encoder, records)
+        print('[+] {:<8} {:8.0f} ns/row {:8.1f} bytes/row'.format(
+            name, seconds / len(records) * 1e9, peak / len(records)))
+    print('[*] Copying {} staging rows to PostgreSQL'.format(len(records)))
+    asyncio.get_event_loop().run_until_complete(bench_copy_to_db(records))
+
+
+def parse_cli():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the Rotulus seeder')
+    parser.add_argument('-b', '--benchmark', choices=['records', 'copy'], default='records',
+                        help='Benchmark to run (default: records)')
+    parser.add_argument('-n', '--lines', type=int, default=200000,
+                        help='Number of lines of the benchmark input (default: 200000)')
+    args = parser.parse_args()
+
+    if args.benchmark == 'records':
+        bench_records(args.lines)
+    elif args.benchmark == 'copy':
+        bench_copy(args.lines)
+
+
+def main():
+    try:
+        parse_cli()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
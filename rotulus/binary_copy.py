@@ -0,0 +1,53 @@
+import struct
+
+HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+TRAILER = struct.pack('!h', -1)
+# field count and username length, then domain id length, value and secret length
+STAGING_HEAD = struct.Struct('!hi')
+STAGING_MIDDLE = struct.Struct('!iqi')
+ROWS_PER_MESSAGE = 8192
+
+
+def encode_staging_rows(buffer, records):
+    """Appends (username, domain_id, secret) records to buffer in PostgreSQL
+    binary COPY format, secrets being bytea or text"""
+    head = STAGING_HEAD.pack
+    middle = STAGING_MIDDLE.pack
+    for record in records:
+        username = record[0]
+        secret = record[2]
+        if isinstance(secret, str):
+            secret = secret.encode()
+        buffer += head(3, len(username))
+        buffer += username
+        buffer += middle(8, record[1], len(secret))
+        buffer += secret
+
+
+class BinaryCopy:
+    """Buffer of a writer streaming records to a binary COPY.
+
+    Records are encoded rows_per_message at a time in the same buffer, which
+    asyncpg copies into its protocol message before asking for the next one.
+    """
+
+    def __init__(self, rows_per_message=ROWS_PER_MESSAGE):
+        self.buffer = bytearray()
+        self.rows_per_message = rows_per_message
+
+    async def staging_rows(self, records):
+        buffer = self.buffer
+        del buffer[:]
+        buffer += HEADER
+        for start in range(0, len(records), self.rows_per_message):
+            end = start + self.rows_per_message
+            encode_staging_rows(buffer, records[start:end])
+            if end >= len(records):
+                buffer += TRAILER
+            view = memoryview(buffer)
+            yield view
+            view.release()
+            del buffer[:]
+        if not records:
+            buffer += TRAILER
+            yield bytes(buffer)
@@ -0,0 +1,92 @@
+import json
+import os
+
+DEFAULT_JOURNAL = 'rotulus_checkpoint.json'
+
+
+def file_key(name):
+    if name.startswith('<stdin>'):
+        return name
+    return os.path.abspath(name)
+
+
+def read_journal(path):
+    try:
+        with open(path, 'r') as journal:
+            return json.load(journal)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        print('[!] Unable to read checkpoint journal {}'.format(path))
+        return {}
+
+
+def write_journal(path, offsets):
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as journal:
+        json.dump(offsets, journal, indent=2)
+        journal.flush()
+        os.fsync(journal.fileno())
+    os.replace(tmp_path, path)
+
+
+class Checkpoint:
+    """Committed byte offsets of input files.
+
+    Batches are numbered in the order they are queued. A file offset is
+    marked with the batch holding the last record read before it, and
+    becomes durable once that batch and all the previous ones are committed.
+    """
+
+    def __init__(self, path, offsets=None):
+        self.path = path
+        self.offsets = dict(offsets or {})
+        self.marks = []
+        self.parts = {}
+        self.committed = set()
+        self.failed = False
+        self.watermark = 0
+
+    def offset(self, key):
+        return self.offsets.get(key, 0)
+
+    def add_part(self, batch_id):
+        self.parts[batch_id] = self.parts.get(batch_id, 0) + 1
+
+    def mark(self, key, offset, batch_id):
+        if batch_id < self.watermark:
+            self.offsets[key] = offset
+            self.save()
+        else:
+            self.marks.append((batch_id, key, offset))
+
+    def commit(self, batch_id, success=True):
+        if not success:
+            if not self.failed:
+                print('[!] Checkpoint held before the failed batch, resuming will load again the following ones')
+            self.failed = True
+            return
+        self.parts[batch_id] -= 1
+        if self.parts[batch_id]:
+            return
+        del self.parts[batch_id]
+        self.committed.add(batch_id)
+        if self.failed:
+            return
+        while self.watermark in self.committed:
+            self.committed.remove(self.watermark)
+            self.watermark += 1
+        durable = [mark for mark in self.marks if mark[0] < self.watermark]
+        if durable:
+            self.marks = self.marks[len(durable):]
+            for _, key, offset in durable:
+                self.offsets[key] = offset
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        try:
+            write_journal(self.path, self.offsets)
+        except OSError as e:
+            print('[!] Unable to write checkpoint journal {}: {}'.format(self.path, e))
@@ -1,5 +1,7 @@
 import argparse
 import asyncio
+import concurrent.futures
+import json
 import os
 import signal
 import sys
@@ -9,6 +11,8 @@ import asyncpg
 import psycopg2
 import yaml
 
+from rotulus.record import DIGEST_SIZES
+
 TABLES = [
     {"name": "usernames",
      "columns": [
@@ -78,6 +82,56 @@ HASH_TEMPLATE = {"name": "hashes",
                       }
                  ]}
 
+DIGEST_HASH_TEMPLATE = {"name": "hashes",
+                        "columns": [
+                            {"name": "id",
+                             "properties": "bigserial primary key"
+                             },
+                            {"name": "hash",
+                             "properties": "bytea not null unique"
+                             }
+                        ]}
+
+SCHEMA_VERSION_TABLE = {"name": "schema_version",
+                        "columns": [
+                            {"name": "version",
+                             "properties": "integer primary key"
+                             },
+                            {"name": "name",
+                             "properties": "text not null"
+                             },
+                            {"name": "progress",
+                             "properties": "jsonb not null default '{}'"
+                             },
+                            {"name": "applied",
+                             "properties": "timestamptz"
+                             }
+                        ]}
+
+# columns searched by substring, see create_trigram_indexes
+TRIGRAM_COLUMNS = {"usernames": "username",
+                   "domains": "domain",
+                   "passwords": "password"}
+
+DEFERRED_TABLE = {"name": "deferred_constraints",
+                  "columns": [
+                      {"name": "id",
+                       "properties": "serial primary key"
+                       },
+                      {"name": "kind",
+                       "properties": "text not null"
+                       },
+                      {"name": "table_name",
+                       "properties": "text not null"
+                       },
+                      {"name": "name",
+                       "properties": "text not null"
+                       },
+                      {"name": "definition",
+                       "properties": "text not null"
+                       }
+                  ]}
+
 
 def signal_handler(signal, frame):
     sys.exit(0)
@@ -179,6 +233,26 @@ async def async_db_connect():
         return False
 
 
+async def async_db_pool(size):
+    print('[*] Opening a pool of {} connections to PostgreSQL database'.format(size))
+    db_conf = get_db_conf()
+    if db_conf != False:
+        try:
+            pool = await asyncpg.create_pool(user=db_conf['psql']['username'],
+                                             password=db_conf['psql']['password'],
+                                             host=db_conf['psql']['host'],
+                                             port=db_conf['psql']['port'],
+                                             database=db_conf['psql']['dbname'],
+                                             min_size=size,
+                                             max_size=size)
+            return pool
+        except:
+            print('[!] Error while connecting to PostgreSQL')
+            return False
+    else:
+        return False
+
+
 def execute_query(connection, query):
     try:
         connection.cursor().execute(query)
@@ -207,8 +281,12 @@ def drop_schema(connection):
     return execute_query(connection, query)
 
 
-def create_tables(connection, tables):
+def create_tables(connection, tables, partitions=0):
     for table in tables:
+        if partitions and table["name"] == "records":
+            if create_partitioned_table(connection, table, partitions) == False:
+                return False
+            continue
         print("[*] Creating table rotulus.{}".format(table["name"]))
         query = "create unlogged table rotulus.{}(".format(table["name"])
         nb_colums = len(table["columns"])
@@ -224,16 +302,430 @@ def create_tables(connection, tables):
     return True
 
 
+def create_partitioned_table(connection, table, partitions):
+    print("[*] Creating table rotulus.{} with {} hash partitions on username_id".format(
+        table["name"], partitions))
+    # the partition key must be part of the primary key
+    columns = []
+    references = []
+    for column in table["columns"]:
+        properties, _, reference = column["properties"].replace(" primary key", "").partition(" references ")
+        columns.append("{} {}".format(column["name"], properties))
+        if reference:
+            references.append((column["name"], reference))
+    columns.append("primary key (id, username_id)")
+    # a partitioned table cannot be unlogged, only its partitions hold rows
+    query = "create table rotulus.{}({}) partition by hash (username_id);".format(
+        table["name"], ", ".join(columns))
+    if execute_query(connection, query) == False:
+        return False
+    for remainder in range(partitions):
+        query = "create unlogged table rotulus.{}_p{} partition of rotulus.{} \
+            for values with (modulus {}, remainder {});".format(
+            table["name"], remainder, table["name"], partitions, remainder)
+        if execute_query(connection, query) == False:
+            return False
+    for column, reference in references:
+        if execute_query(connection, partition_foreign_keys(connection, column, reference)) == False:
+            return False
+    return True
+
+
+def records_partitioned(connection):
+    cursor = connection.cursor()
+    cursor.execute("select relkind = 'p' from pg_class where oid = 'rotulus.records'::regclass")
+    partitioned = cursor.fetchone()[0]
+    connection.commit()
+    return partitioned
+
+
+def partition_foreign_keys(connection, column, reference):
+    """Declares a foreign key of rotulus.records on each of its partitions, the
+    logged partitioned table cannot reference the unlogged tables itself"""
+    return "; ".join("alter table {} add foreign key ({}) references {}".format(partition, column, reference)
+                     for partition in select_partitions(connection))
+
+
+def select_partitions(connection, table="records"):
+    """Partitions of rotulus.<table>, or the table itself when it is not partitioned"""
+    cursor = connection.cursor()
+    cursor.execute("select inhrelid::regclass::text from pg_inherits \
+            where inhparent = %s::regclass order by inhrelid", ("rotulus.{}".format(table),))
+    partitions = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return partitions or ["rotulus.{}".format(table)]
+
+
+def maintain_partition(partition, action):
+    connection = db_connect()
+    if connection == False:
+        return False
+    # vacuum cannot run inside a transaction
+    connection.autocommit = True
+    print("[*] {} {}".format(action.capitalize(), partition))
+    try:
+        if action == "vacuum":
+            connection.cursor().execute("vacuum (analyze) {}".format(partition))
+        else:
+            connection.cursor().execute("reindex table {}".format(partition))
+        return True
+    except (Exception, psycopg2.Error) as error:
+        print("[!] Unable to {} {}".format(action, partition))
+        print(error)
+        return False
+    finally:
+        close_communication(connection)
+
+
+def maintain_records(action, jobs=1):
+    """Vacuums or reindexes rotulus.records one partition at a time, jobs of them at once"""
+    connection = db_connect()
+    if connection == False:
+        return False
+    partitions = select_partitions(connection)
+    close_communication(connection)
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        return all(executor.map(lambda partition: maintain_partition(partition, action), partitions))
+
+
+def create_trigram_indexes():
+    """Builds the GIN trigram indexes over the escaped text of usernames,
+    domains and passwords, without locking writes"""
+    connection = db_connect()
+    if connection == False:
+        return False
+    # create index concurrently cannot run inside a transaction
+    connection.autocommit = True
+    if execute_query(connection, "create extension if not exists pg_trgm") == False:
+        close_communication(connection)
+        return False
+    ret = True
+    for table, column in TRIGRAM_COLUMNS.items():
+        print("[*] Creating trigram index of rotulus.{}".format(table))
+        query = "create index concurrently if not exists {}_{}_trgm on rotulus.{} \
+            using gin (encode({}, 'escape') gin_trgm_ops)".format(table, column, table, column)
+        if execute_query(connection, query) == False:
+            # a failed concurrent build leaves an invalid index behind
+            execute_query(connection, "drop index concurrently if exists rotulus.{}_{}_trgm".format(
+                table, column))
+            ret = False
+    close_communication(connection)
+    if ret:
+        print("[+] Trigram indexes created")
+    return ret
+
+
+def drop_trigram_indexes():
+    connection = db_connect()
+    if connection == False:
+        return False
+    connection.autocommit = True
+    ret = True
+    for table, column in TRIGRAM_COLUMNS.items():
+        print("[*] Dropping trigram index of rotulus.{}".format(table))
+        ret = execute_query(connection, "drop index concurrently if exists rotulus.{}_{}_trgm".format(
+            table, column)) and ret
+    close_communication(connection)
+    return ret
+
+
 def create_hash_table(connection, hash_type):
-    hash_table = HASH_TEMPLATE
+    # fixed length hex hashes are stored as their binary digest
+    template = DIGEST_HASH_TEMPLATE if hash_type in DIGEST_SIZES else HASH_TEMPLATE
+    hash_table = dict(template)
     hash_table["name"] = "{}_{}".format(
-        hash_type, HASH_TEMPLATE["name"])
+        hash_type, template["name"])
     return create_tables(connection, [hash_table])
 
 
+def select_hash_columns(connection):
+    """{hash_type: type of the hash column} of the rotulus.<hash_type>_hashes
+    tables referenced by a rotulus.records column"""
+    cursor = connection.cursor()
+    cursor.execute("select h.table_name, h.data_type from information_schema.columns h \
+            inner join information_schema.columns r \
+                on r.table_schema = 'rotulus' and r.table_name = 'records' \
+                and r.column_name = left(h.table_name, -length('_hashes')) || '_id' \
+            where h.table_schema = 'rotulus' and h.table_name like '%\\_hashes' and h.column_name = 'hash'")
+    columns = {table[:-len("_hashes")]: data_type for table, data_type in cursor.fetchall()}
+    cursor.close()
+    return columns
+
+
+def prepare_hash_table(connection, hash_type):
+    """Creates rotulus.<hash_type>_hashes and its rotulus.records column,
+    reusing the table an interrupted run may have left"""
+    cursor = connection.cursor()
+    cursor.execute("select to_regclass(%s)", ("rotulus.{}_hashes".format(hash_type),))
+    exists = cursor.fetchone()[0] is not None
+    connection.commit()
+    return (exists or create_hash_table(connection, hash_type)) and alter_records_table(connection, hash_type)
+
+
+def prepare_salted_table(connection, hash_type):
+    salted_type = "{}_salted".format(hash_type)
+    if salted_type in select_hash_columns(connection):
+        return True
+    return prepare_hash_table(connection, salted_type) \
+        and execute_query(connection, "insert into rotulus.hashes_types (hash_type) values ('{}') \
+            on conflict (hash_type) do nothing".format(salted_type))
+
+
+def prepare_digest_table(migration, hash_type):
+    """Moves the salted hashes of a text hash table to its _salted table and
+    merges the hashes differing only by case, False when other hashes are
+    not hex digests. Records are updated in batches, and errors are raised
+    to stop the migration."""
+    connection = migration.connection
+    table = "rotulus.{}_hashes".format(hash_type)
+    salted_table = "rotulus.{}_salted_hashes".format(hash_type)
+    digest = "[0-9a-fA-F]{{{}}}".format(2 * DIGEST_SIZES[hash_type])
+    cursor = connection.cursor()
+    cursor.execute("select count(*) filter (where hash ~ %s), count(*) filter (where hash !~ %s) \
+        from {}".format(table), ("^{}:".format(digest), "^{}$".format(digest)))
+    salted, invalid = cursor.fetchone()
+    connection.commit()
+    if invalid > salted:
+        print("[!] {} hashes of {} are not hex digests, table kept as text".format(invalid - salted, table))
+        return False
+    if salted:
+        print("[*] Moving {} salted hashes of {} to {}".format(salted, table, salted_table))
+        if prepare_salted_table(connection, hash_type) == False:
+            raise RuntimeError("unable to create {}".format(salted_table))
+        migration.execute("insert into {} (hash) select hash from {} where hash ~ %s order by 1 \
+            on conflict (hash) do nothing".format(salted_table, table), ("^{}:".format(digest),))
+        migration.update_batches(
+            "{} salted".format(table), "rotulus.records",
+            "{0}_salted_id = (select s.id from {1} h inner join {2} s on s.hash = h.hash \
+                where h.id = records.{0}_id), {0}_id = null".format(hash_type, table, salted_table),
+            "{}_id in (select id from {} where hash ~ '^{}:')".format(hash_type, table, digest))
+        migration.execute("delete from {} where hash ~ %s".format(table), ("^{}:".format(digest),))
+    # hashes differing only by case become the same digest, the duplicates
+    # are kept in a table until their records point to the kept one
+    duplicates = "rotulus.{}_digest_duplicates".format(hash_type)
+    cursor.execute("select to_regclass(%s)", (duplicates,))
+    if cursor.fetchone()[0] is None:
+        cursor.execute("create unlogged table {} (id bigint primary key, keep bigint not null)".format(duplicates))
+        cursor.execute("insert into {} select id, keep from ( \
+                select id, min(id) over (partition by lower(hash)) as keep from {} \
+                where lower(hash) in (select lower(hash) from {} where hash ~ '[A-F]')) d \
+            where id <> keep".format(duplicates, table, table))
+    connection.commit()
+    cursor.execute("select count(*) from {}".format(duplicates))
+    merged = cursor.fetchone()[0]
+    connection.commit()
+    if merged:
+        print("[*] Merging {} hashes of {} differing only by case".format(merged, table))
+        migration.update_batches(
+            "{} case".format(table), "rotulus.records",
+            "{0}_id = (select d.keep from {1} d where d.id = records.{0}_id)".format(hash_type, duplicates),
+            "{}_id in (select id from {})".format(hash_type, duplicates))
+        cursor.execute("delete from {} h using {} d where h.id = d.id".format(table, duplicates))
+    cursor.execute("drop table {}".format(duplicates))
+    connection.commit()
+    return True
+
+
+class Migration:
+    """Steps of a schema migration.
+
+    Steps are idempotent, an interrupted migration is applied again from its
+    start. Batched updates also save the last id they updated in
+    rotulus.schema_version, and resume after it.
+    """
+
+    def __init__(self, connection, version, progress, batch_size):
+        self.connection = connection
+        self.version = version
+        self.progress = progress
+        self.batch_size = batch_size
+
+    def execute(self, query, params=None):
+        self.connection.cursor().execute(query, params)
+        self.connection.commit()
+
+    def update_batches(self, step, table, assignments, where="true"):
+        """Updates table batch_size ids at once, up to its last id when the step started"""
+        cursor = self.connection.cursor()
+        cursor.execute("select coalesce(max(id), 0) from {}".format(table))
+        last = cursor.fetchone()[0]
+        position = self.progress.get(step, 0)
+        while position < last:
+            end = min(position + self.batch_size, last)
+            cursor.execute("update {} set {} where id > %s and id <= %s and ({})".format(
+                table, assignments, where), (position, end))
+            position = self.progress[step] = end
+            cursor.execute("update rotulus.schema_version set progress = %s where version = %s",
+                           (json.dumps(self.progress), self.version))
+            self.connection.commit()
+            print("[*] {}: {} of {} ids ({:.1f}%)".format(step, position, last, position * 100 / last))
+
+    def create_index(self, name, table, definition, unique=False):
+        """Builds an index without blocking writes, again when an interrupted
+        build left it invalid"""
+        cursor = self.connection.cursor()
+        cursor.execute("select indisvalid from pg_index where indexrelid = to_regclass(%s)",
+                       ("rotulus.{}".format(name),))
+        row = cursor.fetchone()
+        cursor.execute("select relkind from pg_class where oid = %s::regclass", (table,))
+        partitioned = cursor.fetchone()[0] == 'p'
+        self.connection.commit()
+        if row and row[0]:
+            return
+        if partitioned:
+            # partitioned tables cannot be indexed concurrently
+            print("[*] Creating index {} of {}".format(name, table))
+            self.execute('create {}index if not exists "{}" on {} {}'.format(
+                "unique " if unique else "", name, table, definition))
+            return
+        # concurrent index builds cannot run inside a transaction
+        self.connection.autocommit = True
+        try:
+            if row:
+                cursor.execute('drop index concurrently rotulus."{}"'.format(name))
+            print("[*] Creating index {} of {}".format(name, table))
+            cursor.execute('create {}index concurrently "{}" on {} {}'.format(
+                "unique " if unique else "", name, table, definition))
+        finally:
+            self.connection.autocommit = False
+
+    def rewrite_column(self, table, column, column_type, using):
+        """Changes the type of a unique column without locking table during
+        the rewrite: a new column is filled in batches and indexed
+        concurrently, then swapped with the old one"""
+        name = table.split(".")[-1]
+        new_column = "{}_{}".format(column, self.version)
+        cursor = self.connection.cursor()
+        cursor.execute("select data_type from information_schema.columns \
+                where table_schema = 'rotulus' and table_name = %s and column_name = %s", (name, column))
+        if cursor.fetchone()[0] == column_type:
+            self.connection.commit()
+            return
+        self.execute("alter table {} add column if not exists {} {}".format(table, new_column, column_type))
+        self.update_batches("{}.{}".format(table, column), table,
+                            "{} = {}".format(new_column, using), "{} is null".format(new_column))
+        index = "{}_{}_key".format(name, new_column)
+        self.create_index(index, table, "({})".format(new_column), unique=True)
+        print("[*] Swapping {}.{} with {}".format(table, column, new_column))
+        # rows written since the batches are rewritten under the swap lock
+        cursor.execute("lock table {} in exclusive mode".format(table))
+        cursor.execute("update {} set {} = {} where {} is null".format(table, new_column, using, new_column))
+        cursor.execute("alter table {} drop column {}".format(table, column))
+        cursor.execute("alter table {} rename column {} to {}".format(table, new_column, column))
+        cursor.execute("alter table {} alter column {} set not null".format(table, column))
+        cursor.execute('alter table {} add constraint "{}_{}_key" unique using index "{}"'.format(
+            table, name, column, index))
+        self.connection.commit()
+
+
+def add_suffix_index(migration):
+    migration.create_index("domains_domain_suffix", "rotulus.domains",
+                           "(reverse(encode(domain, 'escape')) text_pattern_ops)")
+
+
+def index_hash_ids(migration):
+    for hash_type in select_hash_columns(migration.connection):
+        migration.create_index("records_{}_id".format(hash_type), "rotulus.records", "({}_id)".format(hash_type))
+
+
+def index_record_ids(migration):
+    # searches find usernames and passwords, then their records
+    for column in ("username_id", "password_id"):
+        migration.create_index("records_{}".format(column), "rotulus.records", "({})".format(column))
+
+
+def index_record_domains(migration):
+    # suffix searches range scan the reversed domains, then their records
+    migration.create_index("records_domain_id", "rotulus.records", "(domain_id)")
+
+
+def digest_hashes(migration):
+    for hash_type, data_type in select_hash_columns(migration.connection).items():
+        if data_type == "text" and hash_type in DIGEST_SIZES:
+            if prepare_digest_table(migration, hash_type):
+                migration.rewrite_column("rotulus.{}_hashes".format(hash_type), "hash", "bytea",
+                                         "decode(hash, 'hex')")
+
+
+# versions of the schema, a new database is created at version 0 and migrated
+MIGRATIONS = [
+    (1, "index of reversed domains", add_suffix_index),
+    (2, "hex hashes as binary digests", digest_hashes),
+    (3, "index of the hash ids of records", index_hash_ids),
+    (4, "index of the username and password ids of records", index_record_ids),
+    (5, "index of the domain ids of records", index_record_domains),
+]
+
+
+def select_schema_versions(connection):
+    """{version: (progress, applied)} of the migrations started"""
+    cursor = connection.cursor()
+    cursor.execute("select to_regclass('rotulus.{}')".format(SCHEMA_VERSION_TABLE["name"]))
+    if cursor.fetchone()[0] is None:
+        if create_tables(connection, [SCHEMA_VERSION_TABLE]) == False:
+            return None
+    cursor.execute("select version, progress, applied from rotulus.schema_version")
+    versions = {version: (progress, applied) for version, progress, applied in cursor.fetchall()}
+    connection.commit()
+    return versions
+
+
+def migrate_database(batch_size=100000):
+    connection = db_connect()
+    if connection == False:
+        return False
+    try:
+        cursor = connection.cursor()
+        # the lock is held by the session, until the connection is closed
+        cursor.execute("select pg_try_advisory_lock(hashtext('rotulus.migrate'))")
+        if not cursor.fetchone()[0]:
+            print("[!] Another migration is running")
+            return False
+        versions = select_schema_versions(connection)
+        if versions is None:
+            return False
+        pending = [migration for migration in MIGRATIONS
+                   if versions.get(migration[0], ({}, None))[1] is None]
+        current = max([version for version, (_, applied) in versions.items() if applied], default=0)
+        print("[*] Schema version {}, {} migrations to apply".format(current, len(pending)))
+        for version, name, function in pending:
+            print("[*] Applying migration {}: {}".format(version, name))
+            cursor.execute("insert into rotulus.schema_version (version, name) values (%s, %s) \
+                on conflict (version) do nothing", (version, name))
+            connection.commit()
+            function(Migration(connection, version, versions.get(version, ({}, None))[0], batch_size))
+            cursor.execute("update rotulus.schema_version set applied = now() where version = %s", (version,))
+            connection.commit()
+            current = version
+        print("[+] Schema at version {}".format(current))
+        return True
+    except (Exception, psycopg2.Error) as error:
+        connection.rollback()
+        print("[!] Migration interrupted, run it again to resume")
+        print(error)
+        return False
+    finally:
+        close_communication(connection)
+
+
 def alter_records_table(connection, hash_type):
-    query = 'alter table rotulus.records add column {}_id bigint references rotulus.{}_hashes(id)'.format(
-        hash_type, hash_type)
+    # records are searched by hash through the index of their hash id
+    index = 'create index if not exists records_{0}_id on rotulus.records ({0}_id)'.format(hash_type)
+    if not records_partitioned(connection):
+        query = 'alter table rotulus.records add column if not exists {}_id bigint references rotulus.{}_hashes(id); {}'.format(
+            hash_type, hash_type, index)
+        return execute_query(connection, query)
+    cursor = connection.cursor()
+    cursor.execute("select 1 from information_schema.columns \
+            where table_schema = 'rotulus' and table_name = 'records' and column_name = %s", ("{}_id".format(hash_type),))
+    exists = cursor.fetchone() is not None
+    connection.commit()
+    if exists:
+        return True
+    # one transaction, the column never exists without its foreign keys
+    query = 'alter table rotulus.records add column {}_id bigint; {}; {}'.format(
+        hash_type, partition_foreign_keys(connection, "{}_id".format(hash_type), "rotulus.{}_hashes(id)".format(hash_type)),
+        index)
     return execute_query(connection, query)
 
 
@@ -246,13 +738,163 @@ def drop_tables(connection, tables):
     return True
 
 
-def setup_database():
+def select_deferrable(connection):
+    """Returns (kind, table, name, definition) of the foreign keys, the
+    records primary key and the non unique indexes of the rotulus schema.
+    Indexes of partitioned tables are defined with their partitions.
+
+    Unique indexes of usernames, domains, passwords and hashes are kept:
+    the seeder upserts rely on them.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""select case contype when 'p' then 'primary' else 'foreign' end, \
+                conrelid::regclass::text, conname, pg_get_constraintdef(oid) \
+            from pg_constraint \
+            where connamespace = 'rotulus'::regnamespace and conparentid = 0 \
+                and (contype = 'f' or (contype = 'p' and conrelid = 'rotulus.records'::regclass)) \
+            union all \
+            select 'index', i.indrelid::regclass::text, c.relname, \
+                replace(pg_get_indexdef(i.indexrelid), ' ON ONLY ', ' ON ') \
+            from pg_index i \
+                inner join pg_class c on c.oid = i.indexrelid \
+            where c.relnamespace = 'rotulus'::regnamespace \
+                and not i.indisunique and not i.indisprimary \
+                and not c.relispartition""")
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+
+def begin_bulk_load():
+    """Drops foreign keys and secondary indexes before a large load, their
+    definitions are saved in rotulus.deferred_constraints"""
+    connection = db_connect()
+    if connection == False:
+        return False
+    try:
+        cursor = connection.cursor()
+        cursor.execute("create table if not exists rotulus.{}({})".format(
+            DEFERRED_TABLE["name"],
+            ", ".join("{} {}".format(column["name"], column["properties"])
+                      for column in DEFERRED_TABLE["columns"])))
+        deferrable = select_deferrable(connection)
+        # foreign keys first, they may depend on the primary key
+        deferrable.sort(key=lambda row: row[0] != 'foreign')
+        for kind, table, name, definition in deferrable:
+            print("[*] Dropping {} {} of {}".format(kind, name, table))
+            cursor.execute("insert into rotulus.deferred_constraints (kind, table_name, name, definition) \
+                values (%s, %s, %s, %s)", (kind, table, name, definition))
+            if kind == 'index':
+                cursor.execute('drop index rotulus."{}"'.format(name))
+            else:
+                cursor.execute('alter table {} drop constraint "{}"'.format(table, name))
+        connection.commit()
+        print("[+] Bulk load mode enabled, {} constraints and indexes deferred".format(len(deferrable)))
+        return True
+    except (Exception, psycopg2.Error) as error:
+        connection.rollback()
+        print("[!] Unable to enable bulk load mode")
+        print(error)
+        return False
+    finally:
+        close_communication(connection)
+
+
+def restore_deferred(row_id, query, maintenance_work_mem):
+    connection = db_connect()
+    if connection == False:
+        return False
+    try:
+        cursor = connection.cursor()
+        cursor.execute("set maintenance_work_mem = %s", (maintenance_work_mem,))
+        cursor.execute(query)
+        cursor.execute("delete from rotulus.deferred_constraints where id = %s", (row_id,))
+        connection.commit()
+        return True
+    except (Exception, psycopg2.Error) as error:
+        connection.rollback()
+        print("[!] Unable to execute '{}'".format(query))
+        print(error)
+        return False
+    finally:
+        close_communication(connection)
+
+
+def end_bulk_load(jobs=4, maintenance_work_mem='1GB'):
+    """Rebuilds the indexes dropped by begin_bulk_load, jobs at once, then
+    adds the foreign keys back and validates them"""
+    connection = db_connect()
+    if connection == False:
+        return False
+    cursor = connection.cursor()
+    cursor.execute("select to_regclass('rotulus.deferred_constraints')")
+    if cursor.fetchone()[0] is None:
+        print("[-] Bulk load mode is not enabled")
+        close_communication(connection)
+        return True
+    cursor.execute("select id, kind, table_name, name, definition \
+            from rotulus.deferred_constraints order by id")
+    deferred = cursor.fetchall()
+    close_communication(connection)
+
+    builds = []
+    foreign_keys = []
+    for row_id, kind, table, name, definition in deferred:
+        if kind == 'index':
+            builds.append((row_id, definition))
+        elif kind == 'primary':
+            builds.append((row_id, 'alter table {} add constraint "{}" {}'.format(table, name, definition)))
+        else:
+            foreign_keys.append((row_id, table, name, definition))
+
+    ret = True
+    print("[*] Rebuilding {} indexes, {} at once".format(len(builds), jobs))
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        for success in executor.map(lambda build: restore_deferred(build[0], build[1], maintenance_work_mem), builds):
+            ret = ret and success
+
+    connection = db_connect()
+    if connection == False:
+        return False
+    # not valid constraints are added without scanning, every one is then
+    # checked by a single join instead of a lookup per row; partitioned tables
+    # do not support them and check the rows while adding the constraint
+    cursor = connection.cursor()
+    for row_id, table, name, definition in foreign_keys:
+        cursor.execute("select 1 from pg_constraint where conrelid = %s::regclass and conname = %s",
+                       (table, name))
+        if cursor.fetchone():
+            # added by an interrupted bulk-end, only left to validate
+            continue
+        print("[*] Adding foreign key {} of {}".format(name, table))
+        cursor.execute("select relkind from pg_class where oid = %s::regclass", (table,))
+        not_valid = "" if cursor.fetchone()[0] == 'p' else " not valid"
+        ret = execute_query(connection, 'alter table {} add constraint "{}" {}{}'.format(
+            table, name, definition, not_valid)) and ret
+    if not execute_query(connection, "set maintenance_work_mem = '{}'".format(maintenance_work_mem)):
+        ret = False
+    for row_id, table, name, definition in foreign_keys:
+        print("[*] Validating foreign key {} of {}".format(name, table))
+        if execute_query(connection, 'alter table {} validate constraint "{}"'.format(table, name)):
+            execute_query(connection, "delete from rotulus.deferred_constraints where id = {}".format(row_id))
+        else:
+            ret = False
+    if ret:
+        execute_query(connection, "drop table rotulus.deferred_constraints")
+        print("[+] Bulk load mode disabled")
+    else:
+        print("[!] Some constraints were not restored, run bulk-end again once fixed")
+    close_communication(connection)
+    return ret
+
+
+def setup_database(partitions=0):
     connection = db_connect()
     if connection != False:
         if create_schema(connection):
-            if create_tables(connection, TABLES) == True:
+            if create_tables(connection, TABLES, partitions) == True:
                 close_communication(connection)
-                return True
+                return migrate_database()
             else:
                 connection.rollback()
         close_communication(connection)
@@ -275,19 +917,43 @@ def remove_tables():
 def parse_cli():
     parser = argparse.ArgumentParser(description='Manage Rotulus database')
     parser.add_argument('-d', '--database', choices=[
-                        'init', 'create', 'drop', 'reset'], required=True, help='Action against database tables')
+                        'init', 'create', 'drop', 'reset', 'bulk-begin', 'bulk-end', 'vacuum', 'reindex',
+                        'trigram', 'drop-trigram', 'migrate'],
+                        required=True, help='Action against database tables')
+    parser.add_argument('-p', '--partitions', type=int, default=0,
+                        help='Number of hash partitions of rotulus.records on username_id, '
+                        'for create and reset (default: 0, not partitioned)')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Number of indexes rebuilt by bulk-end, or partitions vacuumed '
+                        'or reindexed, at once (default: 4)')
+    parser.add_argument('-m', '--maintenance-work-mem', default='1GB',
+                        help='Session maintenance_work_mem of index rebuilds (default: 1GB)')
+    parser.add_argument('-b', '--batch-size', type=int, default=100000,
+                        help='Number of ids rewritten per transaction by migrate (default: 100000)')
 
     args = parser.parse_args()
 
     if args.database == "init":
         request_conf()
     elif args.database == "create":
-        setup_database()
+        setup_database(args.partitions)
     elif args.database == "drop":
         remove_tables()
     elif args.database == "reset":
         remove_tables()
-        setup_database()
+        setup_database(args.partitions)
+    elif args.database == "bulk-begin":
+        begin_bulk_load()
+    elif args.database == "bulk-end":
+        end_bulk_load(args.jobs, args.maintenance_work_mem)
+    elif args.database in ("vacuum", "reindex"):
+        maintain_records(args.database, args.jobs)
+    elif args.database == "trigram":
+        create_trigram_indexes()
+    elif args.database == "drop-trigram":
+        drop_trigram_indexes()
+    elif args.database == "migrate":
+        migrate_database(args.batch_size)
 
 
 def main():
@@ -0,0 +1,166 @@
+import argparse
+import heapq
+import os
+import shutil
+import signal
+import sys
+import tempfile
+
+from rotulus.reader import open_sources, read_blocks, split_lines
+
+# approximate memory used by a line held in a set, besides its bytes
+LINE_OVERHEAD = 100
+MAX_RUNS = 128
+BUFFER_SIZE = 1024 * 1024
+
+
+def signal_handler(signal, frame):
+    print('[-] Stopping the deduplication')
+    sys.exit(0)
+
+
+def parse_cli():
+    parser = argparse.ArgumentParser(description='Remove duplicate lines of dumps before loading them')
+    parser.add_argument('-f', '--file',
+                        required=True,
+                        help='One or more files containing email address, password or hash',
+                        type=argparse.FileType('rb'),
+                        nargs='+')
+    parser.add_argument('-s', '--spliter',
+                        required=True,
+                        type=os.fsencode,
+                        help='Character to split line')
+    parser.add_argument('-o', '--output',
+                        required=True,
+                        help='File receiving the deduplicated lines')
+    parser.add_argument('-m', '--memory',
+                        type=int,
+                        default=1024,
+                        help='Memory in MB holding lines before they are spilled to disk (default: 1024)')
+    parser.add_argument('-t', '--tmp-dir',
+                        help='Directory of the sorted runs spilled to disk (default: system temporary directory)')
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        default=16,
+                        help='Size in MB of the file chunks read at once (default: 16)')
+
+    return parser.parse_args()
+
+
+def normalize_line(line, spliter):
+    """Line with its email address stripped and lowercased, unchanged when
+    it is not an email<spliter>secret line"""
+    email, sep, secret = line.partition(spliter)
+    if not sep or b'@' not in email:
+        return line
+    return email.strip().lower() + spliter + secret.rstrip(b'\r')
+
+
+class ExternalSort:
+    """Sorted distinct lines of an input larger than memory.
+
+    Lines are kept in a set until memory bytes are used, then written
+    sorted in a run file of tmp_dir. Runs are merged, at most MAX_RUNS at
+    once, while duplicates are skipped.
+    """
+
+    def __init__(self, memory, tmp_dir=None):
+        self.memory = memory
+        self.directory = tempfile.mkdtemp(prefix='rotulus_dedup_', dir=tmp_dir)
+        self.lines = set()
+        self.size = 0
+        self.runs = []
+        self.nb_runs = 0
+        self.count = 0
+
+    def add(self, line):
+        self.count += 1
+        if line in self.lines:
+            return
+        self.lines.add(line)
+        self.size += len(line) + LINE_OVERHEAD
+        if self.size >= self.memory:
+            self.spill()
+
+    def new_run(self):
+        self.nb_runs += 1
+        return os.path.join(self.directory, 'run_{}'.format(self.nb_runs))
+
+    def spill(self):
+        if not self.lines:
+            return
+        path = self.new_run()
+        with open(path, 'wb', buffering=BUFFER_SIZE) as run:
+            # sorted with their newline, as heapq.merge compares them
+            run.writelines(sorted(line + b'\n' for line in self.lines))
+        self.runs.append(path)
+        self.lines = set()
+        self.size = 0
+
+    def merge(self, runs):
+        files = [open(path, 'rb', buffering=BUFFER_SIZE) for path in runs]
+        try:
+            previous = None
+            for line in heapq.merge(*files):
+                if line != previous:
+                    previous = line
+                    yield line[:-1]
+        finally:
+            for file in files:
+                file.close()
+            for path in runs:
+                os.remove(path)
+
+    def unique(self):
+        """Yields the distinct lines, sorted"""
+        if not self.runs:
+            yield from sorted(self.lines, key=lambda line: line + b'\n')
+            return
+        self.spill()
+        print('[*] Merging {} sorted runs'.format(len(self.runs)))
+        while len(self.runs) > MAX_RUNS:
+            runs = self.runs[:MAX_RUNS]
+            path = self.new_run()
+            with open(path, 'wb', buffering=BUFFER_SIZE) as run:
+                run.writelines(line + b'\n' for line in self.merge(runs))
+            self.runs = self.runs[MAX_RUNS:] + [path]
+        yield from self.merge(self.runs)
+
+    def write(self, path):
+        """Writes the distinct lines in path and returns their number"""
+        nb_lines = 0
+        with open(path, 'wb', buffering=BUFFER_SIZE) as output:
+            for line in self.unique():
+                output.write(line + b'\n')
+                nb_lines += 1
+        print('[*] {} lines, {} distinct, {} runs spilled to disk'.format(self.count, nb_lines, self.nb_runs))
+        return nb_lines
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def dedup_files(files, spliter, output, memory, tmp_dir=None, block_size=16 * 1024 * 1024):
+    sorter = ExternalSort(memory, tmp_dir)
+    try:
+        for file in files:
+            for name, stream, _, _ in open_sources(file):
+                print('[*] Reading {}'.format(name))
+                for block in read_blocks(stream, block_size):
+                    for line in split_lines(block):
+                        sorter.add(normalize_line(line, spliter))
+        sorter.write(output)
+    finally:
+        sorter.close()
+    print('[+] Deduplicated lines writed to {}'.format(output))
+
+
+def main():
+    signal.signal(signal.SIGINT, signal_handler)
+    args = parse_cli()
+    dedup_files(args.file, args.spliter, args.output, args.memory * 1024 * 1024,
+                args.tmp_dir, args.chunk_size * 1024 * 1024)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,8 @@ import sys
 
 import asyncpg
 import psycopg2
-import psycopg2.extras
-from rotulus.database import db_connect
-from rotulus.record import Record
+from rotulus.database import db_connect, select_hash_columns
+from rotulus.record import Record, hex_digest, normalize_hash_type
 
 
 def parse_cli():
@@ -23,7 +22,12 @@ def parse_cli():
                         help='Match string')
     parser.add_argument('-c', '--contain',
                         help='Contain string')
-    return parser.parse_args()
+    parser.add_argument('-x', '--suffix',
+                        help='Domain and its subdomains, with -s domain')
+    args = parser.parse_args()
+    if args.suffix and args.search != 'domain':
+        parser.error('--suffix only applies to -s domain')
+    return args
 
 
 def signal_handler(signal, frame):
@@ -37,6 +41,13 @@ async def select_record_count(connection):
     return await statement.fetchval()
 
 
+async def select_available_connections(connection):
+    query = '''select current_setting('max_connections')::int \
+            - current_setting('superuser_reserved_connections')::int \
+            - (select count(*) from pg_stat_activity where backend_type = 'client backend')'''
+    return await connection.fetchval(query)
+
+
 def hash_type_known(connection, hash_type):
     cur = connection.cursor()
     query = 'select id from rotulus.hashes_types where hash_type like %s'
@@ -50,256 +61,149 @@ def get_hash_types(connection):
     cur.execute(query)
     return cur.fetchall()
 
-def select_record_from_username_id(connection, record_id):
-    cur = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    query = '''select username, domain, password, hash, hash_type 
-            from rotulus.usernames u 
-            inner join rotulus.records r 
-                on u.id = r.username_id 
-            inner join rotulus.domains d 
-                on r.domain_id = d.id 
-            inner join rotulus.passwords p 
-                on r.password_id = p.id 
-            inner join rotulus.hashes h 
-                on r.hash_id = h.id 
-            inner join rotulus.hashes_types t 
-                on h.hash_type_id = t.id 
-            where r.username_id = %s'''
-    cur.execute(query, (record_id,))
-    record = cur.fetchone()
-    yield record
-
-
-def select_record_from_domain_id(connection, record_id):
-    cur = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    query = '''select username, domain, password, hash, hash_type 
-            from rotulus.usernames u 
-            inner join rotulus.records r 
-                on u.id = r.username_id 
-            inner join rotulus.domains d 
-                on r.domain_id = d.id 
-            inner join rotulus.passwords p 
-                on r.password_id = p.id 
-            inner join rotulus.hashes h 
-                on r.hash_id = h.id 
-            inner join rotulus.hashes_types t 
-                on h.hash_type_id = t.id 
-            where r.domain_id = %s'''
-    cur.execute(query, (record_id,))
-    record = cur.fetchone()
-    yield record
-
-
-def select_record_from_password_id(connection, record_id):
-    cur = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    query = '''select username, domain, password, hash, hash_type 
-            from rotulus.usernames u 
-            inner join rotulus.records r 
-                on u.id = r.username_id 
-            inner join rotulus.domains d 
-                on r.domain_id = d.id 
-            inner join rotulus.passwords p 
-                on r.password_id = p.id 
-            inner join rotulus.hashes h 
-                on r.hash_id = h.id 
-            inner join rotulus.hashes_types t 
-                on h.hash_type_id = t.id 
-            where r.domain_id = %s'''
-    cur.execute(query, (record_id,))
-    record = cur.fetchone()
-    yield record
-
-
-def select_record_from_hash_id(connection, record_id):
-    cur = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    query = '''select username, domain, password, hash, hash_type 
-            from rotulus.usernames u 
-            inner join rotulus.records r 
-                on u.id = r.username_id 
-            inner join rotulus.domains d 
-                on r.domain_id = d.id 
-            inner join rotulus.passwords p 
-                on r.password_id = p.id 
-            inner join rotulus.hashes h 
-                on r.hash_id = h.id 
-            inner join rotulus.hashes_types t 
-                on h.hash_type_id = t.id 
-            where r.domain_id = %s'''
-    cur.execute(query, (record_id,))
-    record = cur.fetchone()
-    yield record
-
-
-def select_record_from_hash_type_id(connection, record_id):
-    cur = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    query = '''select username, domain, password, hash, hash_type 
-            from rotulus.usernames u 
-            inner join rotulus.records r 
-                on u.id = r.username_id 
-            inner join rotulus.domains d 
-                on r.domain_id = d.id 
-            inner join rotulus.passwords p 
-                on r.password_id = p.id 
-            inner join rotulus.hashes h 
-                on r.hash_id = h.id 
-            inner join rotulus.hashes_types t 
-                on h.hash_type_id = t.id 
-            where r.domain_id = %s'''
-    cur.execute(query, (record_id,))
-    record = cur.fetchone()
-    yield record
-
-
-def select_username(connection, username):
-    cur = connection.cursor()
-    query = '''select r.id from rotulus.records r 
-            inner join rotulus.usernames u 
-                on r.username_id = u.id 
-            where u.username like %s'''
-    cur.execute(query, (username,))
-    records = cur.fetchall()
-    return records
-
-
-def select_domain(connection, domain):
-    cur = connection.cursor()
-    query = '''select r.id from rotulus.records r 
-            inner join rotulus.domains d
-                on r.domain_id = d.id 
-            where d.domain like %s'''
-    cur.execute(query, (domain,))
-    records = cur.fetchall()
-    return records
-
-
-def select_password(connection, password):
-    cur = connection.cursor()
-    query = '''select r.id from rotulus.records r 
-            inner join rotulus.passwords p 
-                on r.password_id = p.id 
-            where p.password like %s'''
-    cur.execute(query, (password,))
-    records = cur.fetchall()
-    return records
-
-
-def select_hash(connection, hash):
-    cur = connection.cursor()
-    query = '''select r.id from rotulus.records r 
-            inner join rotulus.hashes h 
-                on r.hash_id = h.id 
-            where h.hash like %s'''
-    cur.execute(query, (hash,))
-    records = cur.fetchall()
-    return records
-
-
-def select_hash_type(connection, hash_type):
-    cur = connection.cursor()
-    query = '''select r.id from rotulus.records r 
-            inner join rotulus.hashes_types t 
-                on r.hash_id = t.id 
-            where t.hash_type like %s'''
-    cur.execute(query, (hash_type,))
-    records = cur.fetchall()
-    return records
-
-
-def search_username(connection, username):
-    usernames_records = select_username(connection, username)
-    usernames_id = [record[0] for record in usernames_records]
-    for username_id in usernames_id:
-        rows = select_record_from_username_id(connection, username_id)
-        for row in rows:
-            print_record(row)
-
-
-def search_domain(connection, domain):
-    domains_records = select_domain(connection, domain)
-    domains_id = [record[0] for record in domains_records]
-    for domain_id in domains_id:
-        rows = select_record_from_domain_id(connection, domain_id)
-        for row in rows:
-            print_record(row)
-
-
-def search_password(connection, password):
-    passwords_records = select_password(connection, password)
-    passwords_id = [record[0] for record in passwords_records]
-    for password_id in passwords_id:
-        rows = select_record_from_password_id(connection, password_id)
-        for row in rows:
-            print_record(row)
-
-
-def search_hash(connection, hash):
-    hashes_records = select_hash(connection, hash)
-    hashes_id = [record[0] for record in hashes_records]
-    for hash_id in hashes_id:
-        rows = select_record_from_hash_id(connection, hash_id)
-        for row in rows:
-            print_record(row)
-
-
-def search_hash_type(connection, hash_type):
-    hashes_types_records = select_hash(connection, hash_type)
-    hashes_types_id = [record[0] for record in hashes_types_records]
-    for hash_type_id in hashes_types_id:
-        rows = select_record_from_hash_type_id(connection, hash_type_id)
-        for row in rows:
-            print_record(row)
+def escape_bytea(value):
+    """Text of value as returned by encode(value, 'escape'), which the
+    trigram indexes are built on"""
+    return ''.join('\\\\' if byte == 0x5c else
+                   chr(byte) if 0 < byte < 0x80 else
+                   '\\{:03o}'.format(byte) for byte in value)
+
+
+def like_escape(text):
+    """text with its LIKE wildcards escaped"""
+    for char in ('\\', '%', '_'):
+        text = text.replace(char, '\\' + char)
+    return text
+
+
+def contain_pattern(text):
+    """LIKE pattern matching text anywhere"""
+    return '%' + like_escape(text) + '%'
+
+
+BYTEA_COLUMNS = ('username', 'domain', 'password')
+# equal and contain filters of every searchable column
+FILTERS = {
+    'username': ('u.username = %s', "encode(u.username, 'escape') like %s"),
+    'domain': ('d.domain = %s', "encode(d.domain, 'escape') like %s"),
+    'password': ('p.password = %s', "encode(p.password, 'escape') like %s"),
+    'hash': ('{hash_ids}', '{hash_like}'),
+    'hash_type': ('{hash_type} = %s', '{hash_type} like %s'),
+}
+
+
+def suffix_patterns(domain):
+    """Reversed domain and LIKE pattern of its reversed subdomains, matched
+    by the domains_domain_suffix index"""
+    reversed_domain = escape_bytea(domain.lstrip(b'.'))[::-1]
+    return reversed_domain, like_escape(reversed_domain) + '.%'
+
+
+def hash_values(hash_columns, value, contain=False):
+    """{hash_type: value searched in its table}: the digest of a hex value in
+    binary digest tables, which it cannot be in when it is not a valid one,
+    and the value itself in the others. Hex digests are case insensitive."""
+    values = {}
+    for hash_type, data_type in hash_columns.items():
+        if data_type != 'bytea':
+            values[hash_type] = contain_pattern(value) if contain else value
+        elif contain:
+            values[hash_type] = contain_pattern(value.lower())
+        else:
+            digest = hex_digest(hash_type, value)
+            if digest is not None:
+                values[hash_type] = psycopg2.Binary(digest)
+    return values
+
+
+def hash_ids_filter(hash_types):
+    """Records whose hash id is the one of the value in its table, looked up
+    through the unique index of each rotulus.<hash_type>_hashes table"""
+    if not hash_types:
+        return 'false'
+    return '({})'.format(' or '.join(
+        "r.{0}_id = any(array(select id from rotulus.{0}_hashes where hash = %s))".format(hash_type)
+        for hash_type in hash_types))
+
+
+def hash_like_filter(hash_columns, hash_types):
+    """Records whose hash, as hex for binary digests, contains the value"""
+    if not hash_types:
+        return 'false'
+    return '({})'.format(' or '.join(
+        ("encode(h_{}.hash, 'hex') like %s" if hash_columns[hash_type] == 'bytea'
+         else 'h_{}.hash like %s').format(hash_type)
+        for hash_type in hash_types))
+
+
+def select_records(connection, search, value, contain=False, suffix=False):
+    """Yields (username, domain, password, hash, hash_type) of the records
+    whose search column is equal to, contains, or for domains ends with,
+    value. Rows are streamed by a server side cursor."""
+    hash_columns = select_hash_columns(connection)
+    hash_types = sorted(hash_columns)
+    joins = ''.join(' left join rotulus.{0}_hashes h_{0} on r.{0}_id = h_{0}.id'.format(hash_type)
+                    for hash_type in hash_types)
+    # binary digests are shown and searched as hex
+    hash = 'coalesce({})'.format(', '.join(
+        "encode(h_{}.hash, 'hex')".format(hash_type) if hash_columns[hash_type] == 'bytea'
+        else 'h_{}.hash'.format(hash_type) for hash_type in hash_types)) \
+        if hash_types else 'null::text'
+    hash_type = 'case {} end'.format(' '.join("when r.{0}_id is not null then '{0}'".format(hash_type)
+                                              for hash_type in hash_types)) \
+        if hash_types else 'null::text'
+    if suffix:
+        where = "(reverse(encode(d.domain, 'escape')) = %s or reverse(encode(d.domain, 'escape')) like %s)"
+    else:
+        searched = hash_values(hash_columns, value.decode(), contain) if search == 'hash' else {}
+        where = FILTERS[search][contain].format(hash=hash, hash_type=hash_type,
+                                                hash_ids=hash_ids_filter(sorted(searched)),
+                                                hash_like=hash_like_filter(hash_columns, sorted(searched)))
+    query = '''select username, domain, password, {}, {}
+            from rotulus.records r
+            inner join rotulus.usernames u
+                on r.username_id = u.id
+            left join rotulus.domains d
+                on r.domain_id = d.id
+            left join rotulus.passwords p
+                on r.password_id = p.id{}
+            where {}'''.format(hash, hash_type, joins, where)
+    if suffix:
+        values = suffix_patterns(value)
+    elif search in BYTEA_COLUMNS:
+        values = (contain_pattern(escape_bytea(value)) if contain else psycopg2.Binary(value),)
+    elif search == 'hash':
+        values = tuple(searched[hash_type] for hash_type in sorted(searched))
+    else:
+        values = (contain_pattern(value.decode()) if contain else value.decode(),)
+    cur = connection.cursor(name='rotulus_query')
+    cur.itersize = 10000
+    cur.execute(query, values)
+    for row in cur:
+        yield row
+    cur.close()
 
 
 def print_record(row):
     if row:
-        record = Record()
-        record.set_username(row[0].tobytes())
-        record.set_domain(row[1].tobytes())
-        record.set_password(row[2].tobytes())
-        record.set_password_hash(row[3])
-        record.set_hash_type(row[4])
-        print(record)
+        print(Record(bytes(row[0] or b''), bytes(row[1] or b''), bytes(row[2] or b''), row[3] or '',
+                     normalize_hash_type(row[4] or '')))
 
 
 def query(args):
     connection = db_connect()
     if connection == False:
         return
-    if args.search == 'username':
-        if args.equal:
-            char = args.equal.encode()
-            search_username(connection, char)
-        elif args.contain:
-            char = b'%' + args.contain.encode() + b'%'
-            search_username(connection, char)
-    elif args.search == 'domain':
-        if args.equal:
-            char = args.equal.encode()
-            search_domain(connection, char)
-        elif args.contain:
-            char = b'%' + args.contain.encode() + b'%'
-            search_domain(connection, char)
-    elif args.search == 'password':
-        if args.equal:
-            char = args.equal.encode()
-            search_password(connection, char)
-        elif args.contain:
-            char = b'%' + args.contain.encode() + b'%'
-            search_password(connection, char)
-    elif args.search == 'hash':
-        if args.equal:
-            char = args.equal.encode()
-            search_hash(connection, char)
-        elif args.contain:
-            char = b'%' + args.contain.encode() + b'%'
-            search_hash(connection, char)
-    elif args.search == 'hash_type':
-        if args.equal:
-            char = args.equal.encode()
-            search_hash_type(connection, char)
-        elif args.contain:
-            char = b'%' + args.contain.encode() + b'%'
-            search_hash_type(connection, char)
+    if args.equal:
+        rows = select_records(connection, args.search, args.equal.encode())
+    elif args.contain:
+        rows = select_records(connection, args.search, args.contain.encode(), contain=True)
+    elif args.suffix:
+        rows = select_records(connection, args.search, args.suffix.encode(), suffix=True)
+    else:
+        return
+    for row in rows:
+        print_record(row)
 
 
 def main():
@@ -0,0 +1,180 @@
+import bz2
+import gzip
+import lzma
+import mmap
+import os
+import queue
+import threading
+import zipfile
+import zlib
+
+COMPRESSIONS = {
+    b'\x1f\x8b': 'gzip',
+    b'BZh': 'bz2',
+    b'\xfd7zXZ\x00': 'xz',
+    b'PK\x03\x04': 'zip',
+}
+
+
+def file_chunks(path, chunk_size, start=0):
+    """Yields (start, end) byte ranges of path, each one ending on a newline"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        while start < size:
+            end = start + chunk_size
+            if end >= size:
+                end = size
+            else:
+                file.seek(end)
+                file.readline()
+                end = file.tell()
+            yield start, end
+            start = end
+
+
+def read_chunk(path, start, end):
+    """Returns the bytes of path between start and end through a memory map"""
+    if start == end:
+        return b''
+    with open(path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return data[start:end]
+
+
+def mmap_blocks(file, block_size, start=0):
+    """Yields blocks of about block_size bytes of a regular file, each one ending on a newline"""
+    size = os.fstat(file.fileno()).st_size
+    if size <= start:
+        return
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        while start < size:
+            end = start + block_size
+            if end >= size:
+                end = size
+            else:
+                newline = data.find(b'\n', end)
+                end = size if newline == -1 else newline + 1
+            yield data[start:end]
+            start = end
+
+
+def read_blocks(file, block_size, start=0):
+    """Yields blocks of about block_size bytes of a stream, each one ending on a newline"""
+    while start > 0:
+        skipped = len(file.read(min(start, block_size)))
+        if not skipped:
+            return
+        start -= skipped
+    tail = b''
+    while True:
+        data = file.read(block_size)
+        if not data:
+            break
+        newline = data.rfind(b'\n')
+        if newline == -1:
+            tail += data
+            continue
+        yield tail + data[:newline + 1]
+        tail = data[newline + 1:]
+    if tail:
+        yield tail
+
+
+def mappable(file):
+    try:
+        file.fileno()
+        return file.seekable()
+    except (AttributeError, OSError, ValueError):
+        return False
+
+
+def file_blocks(file, block_size, start=0):
+    if mappable(file):
+        return mmap_blocks(file, block_size, start)
+    return read_blocks(file, block_size, start)
+
+
+def split_lines(block):
+    lines = block.split(b'\n')
+    if lines[-1] == b'':
+        lines.pop()
+    return lines
+
+
+def count_lines(block):
+    nb_lines = block.count(b'\n')
+    if block and not block.endswith(b'\n'):
+        nb_lines += 1
+    return nb_lines
+
+
+def detect_compression(file):
+    try:
+        magic = file.peek(len(max(COMPRESSIONS, key=len)))
+    except (AttributeError, OSError):
+        return None
+    for signature, compression in COMPRESSIONS.items():
+        if magic.startswith(signature):
+            return compression
+    return None
+
+
+def stream_size(file):
+    try:
+        return os.fstat(file.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+def open_sources(file):
+    """Returns (name, stream, compressed, size) of every data stream held by file,
+    size being the number of bytes on disk, or uncompressed for zip members
+    """
+    compression = detect_compression(file)
+    size = stream_size(file)
+    if compression is None:
+        return [(file.name, file, False, size)]
+    print('[*] Reading {} compressed file {}'.format(compression, file.name))
+    if compression == 'gzip':
+        return [(file.name, gzip.GzipFile(fileobj=file, mode='rb'), True, size)]
+    if compression == 'bz2':
+        return [(file.name, bz2.BZ2File(file), True, size)]
+    if compression == 'xz':
+        return [(file.name, lzma.LZMAFile(file), True, size)]
+    try:
+        archive = zipfile.ZipFile(file)
+    except (zipfile.BadZipFile, OSError) as e:
+        print('[!] Unable to read zip archive {}: {}'.format(file.name, e))
+        return []
+    return [('{}:{}'.format(file.name, info.filename), archive.open(info), True, info.file_size)
+            for info in archive.infolist() if not info.is_dir()]
+
+
+# errors of a truncated or corrupt input, which only stop reading that input
+READ_ERRORS = (OSError, EOFError, zlib.error, lzma.LZMAError, zipfile.BadZipFile)
+
+
+def prefetch(blocks, depth):
+    """Iterates blocks produced by a background thread, at most depth blocks ahead"""
+    buffer = queue.Queue(depth)
+
+    def produce():
+        try:
+            for block in blocks:
+                buffer.put(block)
+        except Exception as e:
+            buffer.put(e)
+        buffer.put(None)
+
+    threading.Thread(target=produce, daemon=True).start()
+    return drain(buffer)
+
+
+def drain(buffer):
+    while True:
+        block = buffer.get()
+        if block is None:
+            return
+        if isinstance(block, Exception):
+            raise block
+        yield block
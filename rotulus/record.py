@@ -1,40 +1,64 @@
-import base64
+import collections
+import re
 
+HASH_TYPE_FORBIDDEN_CHARS = re.compile(r'[^a-z0-9_]')
 
-class Record:
-    def __init__(self):
-        self.username = b''
-        self.domain = b''
-        self.password = b''
-        self.hash = ''
-        self.hash_type = ''
 
-    def set_username(self, username):
-        self.username = username
+def normalize_hash_type(hash_type):
+    """Hash type usable in rotulus.<hash_type>_hashes table names"""
+    return HASH_TYPE_FORBIDDEN_CHARS.sub('_', hash_type.lower().replace(' ', ''))
 
-    def set_domain(self, domain):
-        self.domain = domain
 
-    def set_password(self, password):
-        self.password = password
+# hash types whose hex hashes are stored as binary digests, by digest size
+DIGEST_SIZES = {
+    'md4': 16, 'md5': 16, 'ntlm': 16, 'lm': 16,
+    'sha1': 20, 'ripemd_160': 20,
+    'sha224': 28, 'sha256': 32, 'sha384': 48, 'sha512': 64,
+    'sha3_224': 28, 'sha3_256': 32, 'sha3_384': 48, 'sha3_512': 64,
+}
 
-    def set_password_hash(self, p_hash):
-        self.hash = p_hash.decode()
 
-    def set_hash_type(self, hash_type):
-        self.hash_type = hash_type.replace(' ', '')
+def hex_digest(hash_type, value):
+    """Binary digest of a hex hash of a DIGEST_SIZES hash type, None when
+    value is not one"""
+    size = DIGEST_SIZES.get(hash_type)
+    # lines of CRLF dumps keep their \r
+    value = value.strip()
+    if size is None or len(value) != 2 * size:
+        return None
+    try:
+        digest = bytes.fromhex(value)
+    except ValueError:
+        return None
+    # fromhex skips whitespaces
+    return digest if len(digest) == size else None
+
+
+def decode(value):
+    try:
+        return value.decode()
+    except (AttributeError, UnicodeDecodeError):
+        return bytes(value)
+
+
+class Record(collections.namedtuple('Record', ['username', 'domain', 'password', 'hash', 'hash_type'],
+                                    defaults=[b'', b'', b'', '', ''])):
+    """Record displayed by Rotulus.
+
+    The seeder handles plain (username, domain, secret[, hash_type]) tuples
+    and only builds a Record, through from_tuple, when one has to be shown.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_tuple(cls, record):
+        """Record of a seeder tuple, its secret being a hash when it is a str"""
+        username, domain, secret = record[:3]
+        hash_type = normalize_hash_type(record[3]) if len(record) > 3 else ''
+        if isinstance(secret, str):
+            return cls(username, domain, hash=secret, hash_type=hash_type)
+        return cls(username, domain, secret)
 
     def __str__(self):
-        try:
-            username = self.username.decode()
-        except:
-            username = bytes(self.username)
-        try:
-            domain = self.domain.decode()
-        except:
-            domain = bytes(self.domain)
-        try:
-            password = self.password.decode()
-        except:
-            password = bytes(self.password)
-        return '{}@{} {} {} {}'.format(username, domain, password, self.hash, self.hash_type)
+        return '{}@{} {} {} {}'.format(decode(self.username), decode(self.domain), decode(self.password),
+                                       self.hash, self.hash_type)
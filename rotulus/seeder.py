@@ -1,19 +1,45 @@
 import argparse
 import asyncio
+import collections
+import concurrent.futures
+import csv
+import functools
 import hashlib
+import itertools
+import json
 import os
+import re
 import signal
 import sys
+import tempfile
 import time
 
-from rotulus.database import async_db_connect, db_connect, create_hash_table, close_communication, alter_records_table
+import asyncpg
+from rotulus.binary_copy import BinaryCopy
+from rotulus.checkpoint import DEFAULT_JOURNAL, Checkpoint, file_key, read_journal
+from rotulus.database import (async_db_connect, async_db_pool, db_connect, close_communication, begin_bulk_load,
+                              end_bulk_load, prepare_hash_table, select_hash_columns)
+from rotulus.dedup import ExternalSort
 from rotulus.hashid import get_hash_type
-from rotulus.query import select_record_count, hash_type_known
-from rotulus.record import Record
+from rotulus.query import select_available_connections
+from rotulus.reader import (READ_ERRORS, count_lines, file_blocks, file_chunks, mappable, open_sources,
+                            prefetch, read_blocks, read_chunk, split_lines)
+from rotulus.record import hex_digest, normalize_hash_type
+from rotulus.stats import Projection, Stats
+
+# Approximate memory held by one parsed record on top of the raw line
+# (tuple and bytes objects headers).
+RECORD_OVERHEAD = 170
+# Upper bound of automatically sized concurrent writers
+MAX_WRITERS = 16
+# Attempts of a batch aborted by a deadlock between concurrent writers
+DEADLOCK_RETRIES = 5
+# Blocks read ahead from each compressed or piped input
+PREFETCH_DEPTH = 4
 
 
 def signal_handler(signal, frame):
-    print('[-] Stopping the query')
+    print('[-] Stopping the seeder')
     sys.exit(0)
 
 
@@ -26,165 +52,1262 @@ def parse_cli():
                         type=argparse.FileType('rb'),
                         nargs='+')
     parser.add_argument('-s', '--spliter',
-                        required=True,
                         type=os.fsencode,
-                        help='Character to split line')
+                        help='Character to split line (default: detected from the file)')
+    parser.add_argument('--format',
+                        choices=['auto'] + list(PARSERS),
+                        default='auto',
+                        help='Format of input files (default: combo with -s, detected from the file otherwise)')
+    parser.add_argument('--sniff-size',
+                        type=int,
+                        default=64,
+                        help='Size in KB of the beginning of a file sampled to detect its format (default: 64)')
     parser.add_argument('-a', '--hash',
                         action='store_true',
                         help='Use it if passwords are hashed')
     parser.add_argument('-c', '--cipher',
                         help='Set cipher hash type')
+    parser.add_argument('-b', '--bulk',
+                        action='store_true',
+                        help='Load records with COPY through a staging table')
+    parser.add_argument('--copy-format',
+                        choices=['records', 'binary'],
+                        default='records',
+                        help='Encoding of the staging rows of the bulk loader: asyncpg records or the '
+                        'rotulus binary COPY encoder (default: records)')
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=100000,
+                        help='Number of records sent to PostgreSQL at once, initial size with '
+                        '--target-latency (default: 100000)')
+    parser.add_argument('--target-latency',
+                        type=float,
+                        default=2.0,
+                        help='Seconds a batch should take to commit, batch size is tuned toward it, '
+                        '0 to keep --batch-size (default: 2)')
+    parser.add_argument('--min-batch-size',
+                        type=int,
+                        default=1000,
+                        help='Smallest tuned batch size (default: 1000)')
+    parser.add_argument('--max-batch-size',
+                        type=int,
+                        default=1000000,
+                        help='Largest tuned batch size (default: 1000000)')
+    parser.add_argument('--max-memory',
+                        type=int,
+                        default=512,
+                        help='Memory ceiling in MB of the records read and not committed yet: the batch '
+                        'being filled, the queued batches and the ones being written (default: 512)')
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='Number of processes parsing input files (default: 1)')
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        default=16,
+                        help='Size in MB of the file chunks read at once (default: 16)')
+    parser.add_argument('--classify-jobs',
+                        type=int,
+                        default=0,
+                        help='Number of processes detecting hash types with -a, '
+                        '0 to detect them in the parsing processes (default: 0)')
+    parser.add_argument('--queue-size',
+                        type=int,
+                        default=4,
+                        help='Number of chunks waiting between two stages of the pipeline (default: 4)')
+    parser.add_argument('--file-jobs',
+                        type=int,
+                        default=2,
+                        help='Number of input files ingested at once, largest first (default: 2)')
+    parser.add_argument('--decompress-jobs',
+                        type=int,
+                        default=2,
+                        help='Number of compressed files or archive members decompressed at once (default: 2)')
+    parser.add_argument('-w', '--writers',
+                        type=int,
+                        default=0,
+                        help='Number of concurrent connections writing batches '
+                        '(default: half of the free PostgreSQL connections, at most {})'.format(MAX_WRITERS))
+    parser.add_argument('--stats-interval',
+                        type=int,
+                        default=10,
+                        help='Seconds between two throughput reports, 0 to disable (default: 10)')
+    parser.add_argument('--stats-json',
+                        help='Write a JSON summary of the run statistics to this file')
+    parser.add_argument('--checkpoint',
+                        default=DEFAULT_JOURNAL,
+                        help='Journal of committed byte offsets of input files (default: ./{})'.format(DEFAULT_JOURNAL))
+    parser.add_argument('-r', '--resume',
+                        action='store_true',
+                        help='Continue loading input files from the offsets of the checkpoint journal')
+    parser.add_argument('--dedup',
+                        action='store_true',
+                        help='Remove duplicate (email, secret) pairs of input files before loading them')
+    parser.add_argument('--dedup-memory',
+                        type=int,
+                        default=1024,
+                        help='Memory in MB holding pairs before they are spilled to disk by --dedup (default: 1024)')
+    parser.add_argument('--tmp-dir',
+                        help='Directory of the files written by --dedup (default: system temporary directory)')
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help='Read and parse input files without PostgreSQL, reporting what would be loaded')
+    parser.add_argument('--defer-constraints',
+                        action='store_true',
+                        help='Drop foreign keys and secondary indexes during the load and rebuild them afterwards')
+    parser.add_argument('--index-jobs',
+                        type=int,
+                        default=4,
+                        help='Number of indexes rebuilt at once after --defer-constraints (default: 4)')
+    parser.add_argument('--maintenance-work-mem',
+                        default='1GB',
+                        help='Session maintenance_work_mem of the index rebuilds after --defer-constraints '
+                        '(default: 1GB)')
 
     return parser.parse_args()
 
 
-def write_errors(errors):
-    f_name = 'errors_{}.txt'.format(time.strftime('%Y%m%d%H%M%S'))
-    with open(f_name, 'wb') as file:
-        for data in errors:
-            try:
-                if not data.endswith(b'\n'):
-                    data += b'\n'
-            except:
-                pass
-            try:
-                record = data.encode()
-            except:
-                record = data
-            try:
-                file.write(record)
-            except:
-                print('[!] {}'.format(record))
-                continue
-    print('[+] Errors writed to ./{}'.format(f_name))
+class ErrorWriter:
+    def __init__(self):
+        self.f_name = 'errors_{}.txt'.format(time.strftime('%Y%m%d%H%M%S'))
+        self.file = None
+        self.count = 0
+
+    def write(self, data):
+        if self.file is None:
+            self.file = open(self.f_name, 'wb')
+        self.count += 1
+        if not data.endswith(b'\n'):
+            data += b'\n'
+        try:
+            self.file.write(data)
+        except:
+            print('[!] {}'.format(data))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            print('[+] Errors writed to ./{}'.format(self.f_name))
+
+
+async def resolve_ids(connection, table, column, values, column_type='bytea'):
+    """Inserts the distinct values missing from rotulus.<table> and returns
+    a {value: id} dictionary of all of them.
+
+    Values are inserted sorted so that concurrent writers lock them in the
+    same order.
+    """
+    values = sorted(set(values))
+    await connection.execute('''INSERT INTO rotulus.{} ({}) \
+                SELECT v FROM unnest($1::{}[]) v ORDER BY v \
+                ON CONFLICT ({}) DO NOTHING'''.format(table, column, column_type, column), values)
+    rows = await connection.fetch('''SELECT id, {} FROM rotulus.{} \
+                WHERE {} = ANY($1::{}[])'''.format(column, table, column, column_type), values)
+    return {row[1]: row[0] for row in rows}
+
+
+async def insert_records_ids(connection, columns, records):
+    await connection.copy_records_to_table('records', schema_name='rotulus',
+                                           records=records, columns=columns)
+    return len(records)
 
 
 async def insert_records_with_passwords(connection, records):
-    statement = '''WITH ins1 AS ( \
-                INSERT INTO rotulus.usernames (username) VALUES ($1) \
-                ON CONFLICT (username) DO UPDATE SET username=EXCLUDED.username \
-                RETURNING id AS username_id) \
-            , ins2 AS ( \
-                INSERT INTO rotulus.domains (domain) VALUES ($2) \
-                ON CONFLICT (domain) DO UPDATE SET domain=EXCLUDED.domain \
-                RETURNING id AS domain_id) \
-            , ins3 AS ( \
-                INSERT INTO rotulus.passwords (password) VALUES ($3) \
-                ON CONFLICT (password) DO UPDATE SET password=EXCLUDED.password \
-                RETURNING id AS password_id) \
-            INSERT INTO rotulus.records (username_id, domain_id, password_id) \
-            VALUES ( \
-                (select username_id from ins1), \
-                (select domain_id from ins2), \
-                (select password_id from ins3)
-            )'''
-    await connection.executemany(statement, records)
+    async with connection.transaction():
+        usernames = await resolve_ids(connection, 'usernames', 'username',
+                                      [record[0] for record in records])
+        passwords = await resolve_ids(connection, 'passwords', 'password',
+                                      [record[2] for record in records])
+        return await insert_records_ids(connection, ['username_id', 'domain_id', 'password_id'],
+                                        [(usernames[record[0]], record[1], passwords[record[2]])
+                                         for record in records])
+
+
+def secret_type(records):
+    """Column type of the secrets, hashes being text unless stored as digests"""
+    return 'text' if isinstance(records[0][2], str) else 'bytea'
 
 
 async def insert_records_with_hash(connection, records, hash_type):
-    statement = '''WITH ins1 AS ( \
-                INSERT INTO rotulus.usernames (username) VALUES ($1) \
-                ON CONFLICT (username) DO UPDATE SET username=EXCLUDED.username \
-                RETURNING id AS username_id) \
-            , ins2 AS ( \
-                INSERT INTO rotulus.domains (domain) VALUES ($2) \
-                ON CONFLICT (domain) DO UPDATE SET domain=EXCLUDED.domain \
-                RETURNING id AS domain_id) \
-            , ins3 AS ( \
-                INSERT INTO rotulus.hashes_types (hash_type) VALUES ($4) \
-                ON CONFLICT (hash_type) DO UPDATE SET hash_type=EXCLUDED.hash_type \
-                RETURNING id AS hash_type_id) \
-            , ins4 AS ( \
-                INSERT INTO rotulus.{}_hashes (hash) VALUES ($3) \
-                ON CONFLICT (hash) DO UPDATE SET hash=EXCLUDED.hash \
-                RETURNING id AS hash_id) \
-            INSERT INTO rotulus.records (username_id, domain_id, {}_id) \
-            VALUES ( \
-                (select username_id from ins1), \
-                (select domain_id from ins2), \
-                (select hash_id from ins4)
-            )'''.format(hash_type, hash_type)
-    await connection.executemany(statement, records)
-
-
-async def add_records_with_hashes(connection, records):
-    ret = True
+    async with connection.transaction():
+        await connection.execute('''INSERT INTO rotulus.hashes_types (hash_type) VALUES ($1) \
+                ON CONFLICT (hash_type) DO NOTHING''', hash_type)
+        usernames = await resolve_ids(connection, 'usernames', 'username',
+                                      [record[0] for record in records])
+        hashes = await resolve_ids(connection, '{}_hashes'.format(hash_type), 'hash',
+                                   [record[2] for record in records], secret_type(records))
+        return await insert_records_ids(connection, ['username_id', 'domain_id', '{}_id'.format(hash_type)],
+                                        [(usernames[record[0]], record[1], hashes[record[2]])
+                                         for record in records])
+
+
+async def create_staging_table(connection, secret_type):
+    """Creates the staging table of secret_type secrets and returns its name.
+    asyncpg caches the columns of a COPY target per connection by its name,
+    a table name is never reused with another secret type."""
+    table = 'rotulus_staging_{}'.format(secret_type)
+    query = '''create temporary table {} ( \
+                username bytea not null, \
+                domain_id bigint not null, \
+                secret {} not null) \
+            on commit drop'''.format(table, secret_type)
+    await connection.execute(query)
+    return table
+
+
+async def copy_records_to_staging(connection, table, records, copy=None):
+    if copy is None:
+        await connection.copy_records_to_table(table,
+                                               records=(record[:3] for record in records),
+                                               columns=['username', 'domain_id', 'secret'])
+    else:
+        await connection.copy_to_table(table,
+                                       source=copy.staging_rows(records),
+                                       columns=['username', 'domain_id', 'secret'],
+                                       format='binary')
+    await connection.execute('analyze {}'.format(table))
+
+
+async def resolve_staging_ids(connection, table):
+    await connection.execute('''INSERT INTO rotulus.usernames (username) \
+                SELECT DISTINCT username FROM {} ORDER BY username \
+                ON CONFLICT (username) DO NOTHING'''.format(table))
+
+
+def inserted_rows(status):
+    # command tag of an insert is 'INSERT 0 <rows>'
+    return int(status.split()[-1])
+
+
+async def bulk_insert_records_with_passwords(connection, records, copy=None):
+    async with connection.transaction():
+        table = await create_staging_table(connection, 'bytea')
+        await copy_records_to_staging(connection, table, records, copy)
+        await resolve_staging_ids(connection, table)
+        await connection.execute('''INSERT INTO rotulus.passwords (password) \
+                SELECT DISTINCT secret FROM {} ORDER BY secret \
+                ON CONFLICT (password) DO NOTHING'''.format(table))
+        status = await connection.execute('''INSERT INTO rotulus.records (username_id, domain_id, password_id) \
+                SELECT u.id, s.domain_id, p.id FROM {} s \
+                INNER JOIN rotulus.usernames u ON u.username = s.username \
+                INNER JOIN rotulus.passwords p ON p.password = s.secret'''.format(table))
+    return inserted_rows(status)
+
+
+async def bulk_insert_records_with_hash(connection, records, hash_type, copy=None):
+    async with connection.transaction():
+        table = await create_staging_table(connection, secret_type(records))
+        await copy_records_to_staging(connection, table, records, copy)
+        await resolve_staging_ids(connection, table)
+        await connection.execute('''INSERT INTO rotulus.hashes_types (hash_type) VALUES ($1) \
+                ON CONFLICT (hash_type) DO NOTHING''', hash_type)
+        await connection.execute('''INSERT INTO rotulus.{}_hashes (hash) \
+                SELECT DISTINCT secret FROM {} ORDER BY secret \
+                ON CONFLICT (hash) DO NOTHING'''.format(hash_type, table))
+        status = await connection.execute('''INSERT INTO rotulus.records (username_id, domain_id, {}_id) \
+                SELECT u.id, s.domain_id, h.id FROM {} s \
+                INNER JOIN rotulus.usernames u ON u.username = s.username \
+                INNER JOIN rotulus.{}_hashes h ON h.hash = s.secret'''.format(hash_type, table, hash_type))
+    return inserted_rows(status)
+
+
+class DomainCache:
+    """Ids of rotulus.domains kept on the seeder side.
+
+    Domains are few compared to usernames and secrets: they are all loaded
+    once, only the unknown ones are inserted, and records are queued with
+    their domain id instead of the domain itself.
+    """
+
+    def __init__(self):
+        self.ids = {}
+
+    async def load(self, connection):
+        rows = await connection.fetch('SELECT id, domain FROM rotulus.domains')
+        self.ids = {row[1]: row[0] for row in rows}
+        print('[*] {} domains loaded'.format(len(self.ids)))
+
+    async def replace_domains(self, connection, records):
+        ids = self.ids
+        missing = {record[1] for record in records if record[1] not in ids}
+        if missing:
+            ids.update(await resolve_ids(connection, 'domains', 'domain', missing))
+        return [(record[0], ids[record[1]]) + record[2:] for record in records]
+
+
+def prepare_hash_type(hash_type, known_hash_types):
+    """Creates the table of hash_type if needed, known_hash_types maps the
+    hash types ready to be loaded to their hash column type"""
+    if hash_type in known_hash_types:
+        return True
     con = db_connect()
+    if not con:
+        return False
+    known_hash_types.update(select_hash_columns(con))
+    ret = True
+    if hash_type not in known_hash_types:
+        ret = prepare_hash_table(con, hash_type)
+        known_hash_types.update(select_hash_columns(con))
+    close_communication(con)
+    return ret
+
+
+def record_line(record, spliter):
+    """Line of a hash record, written to the errors file"""
+    return record[0] + b'@' + record[1] + spliter + record[2].encode()
+
+
+def digest_records(records):
+    """Records of a hash type stored as binary digests with their digest,
+    records of salted hashes, moved to <hash_type>_salted, and the
+    malformed ones"""
     hash_type = records[0][3]
-    if con:
-        if not hash_type_known(con, hash_type):
-            if create_hash_table(con, hash_type):
-                ret = alter_records_table(con, hash_type)
-        close_communication(con)
-    if ret:
-        await insert_records_with_hash(connection, records, hash_type)
+    salted_type = '{}_salted'.format(hash_type)
+    digests = []
+    salted = []
+    errors = []
+    for record in records:
+        digest = hex_digest(hash_type, record[2])
+        if digest is not None:
+            digests.append(record[:2] + (digest, hash_type))
+        elif hex_digest(hash_type, record[2].partition(':')[0]) is not None:
+            salted.append(record[:3] + (salted_type,))
+        else:
+            errors.append(record)
+    return digests, salted, errors
 
 
-async def insert_in_db(args):
-    connection = await async_db_connect()
-    l_errors = []
+def group_by_hash_type(records):
+    groups = collections.defaultdict(list)
+    for record in records:
+        groups[record[3]].append(record)
+    return groups
+
+
+async def add_records_with_hashes(connection, records, bulk=False, copy=None):
+    hash_type = records[0][3]
+    if bulk:
+        return await bulk_insert_records_with_hash(connection, records, hash_type, copy)
+    return await insert_records_with_hash(connection, records, hash_type)
+
+
+def email_record(args, email, secret):
+    """Record tuple of an email address and its secret, None if unusable"""
+    username, at, domain = email.partition(b'@')
+    if not at:
+        return None
+    if b'@' in domain:
+        domain = domain.partition(b'@')[0]
+    if args.hash or args.cipher:
+        try:
+            secret = secret.decode()
+        except UnicodeDecodeError:
+            return None
+        if args.cipher:
+            # hash type is detected afterwards by classify_records otherwise
+            return username, domain, secret, args.hash_type
+    return username, domain, secret
+
+
+def parse_line(args, line):
+    if line.endswith(b'\n'):
+        line = line[:-1]
+    email, spliter, secret = line.partition(args.spliter)
+    if not spliter:
+        return None, line
+    return email_record(args, email, secret), line
+
+
+async def insert_batch(connection, args, records, copy=None):
+    print('[*] Inserting {} records'.format(len(records)))
+    for attempt in range(DEADLOCK_RETRIES):
+        try:
+            if args.hash or args.cipher:
+                return await add_records_with_hashes(connection, records, args.bulk, copy)
+            if args.bulk:
+                return await bulk_insert_records_with_passwords(connection, records, copy)
+            return await insert_records_with_passwords(connection, records)
+        except asyncpg.exceptions.DeadlockDetectedError as e:
+            # concurrent writers upserting the same values, try again
+            error = e
+        except Exception as e:
+            error = e
+            break
+    print('[!] Error while inserting data to PostgreSQL:\n\t{}'.format(error))
+    return None
+
+
+def parse_options(args):
+    # hash types are detected by the parsers unless a classifier stage does it
+    classify = bool(args.hash and not args.cipher and not getattr(args, 'classify_jobs', 0))
+    return argparse.Namespace(spliter=args.spliter, hash=args.hash, cipher=args.cipher,
+                              hash_type=normalize_hash_type(args.cipher) if args.cipher else None,
+                              format=args.format, columns=None, header=None, classify=classify)
+
+
+def parse_lines(args, lines):
     records = []
-    nb_records = 0
-    before = await select_record_count(connection)
-    for file in args.file:
-        for line in file:
-            nb_records += 1
+    errors = []
+    for line in lines:
+        record, line = parse_line(args, line)
+        if record is None:
+            errors.append(line)
+        else:
+            records.append(record)
+    return records, errors
+
+
+def line_regex(spliter, capture):
+    """Regex of a line accepted by parse_line, for single byte separators"""
+    sep = re.escape(spliter)
+    group = b'(' if capture else b'(?:'
+    return (group + b'[^@\\n' + sep + b']*)@' + group + b'[^@\\n' + sep + b']*)(?:@[^\\n' + sep + b']*)?'
+            + sep + group + b'[^\\n]*)')
+
+
+@functools.lru_cache()
+def line_pattern(spliter):
+    """Regex matching every well-formed line of a block at once.
+
+    Only single byte separators, other than '@' and newline, can be expressed
+    with negated classes matching exactly what parse_line accepts.
+    """
+    if len(spliter) != 1 or spliter in b'@\n':
+        return None
+    return re.compile(b'^' + line_regex(spliter, True) + b'$', re.MULTILINE)
+
+
+@functools.lru_cache()
+def error_pattern(spliter):
+    """Regex matching every line of a block rejected by line_pattern"""
+    return re.compile(b'^(?!\\Z)(?!' + line_regex(spliter, False) + b'$)([^\\n]*)$', re.MULTILINE)
+
+
+def parse_block(args, block):
+    pattern = line_pattern(args.spliter)
+    if pattern is not None:
+        matches = pattern.findall(block)
+        errors = []
+        nb_lines = count_lines(block)
+        if len(matches) != nb_lines:
+            errors = error_pattern(args.spliter).findall(block)
+        if len(matches) + len(errors) == nb_lines:
+            if not (args.hash or args.cipher):
+                return matches, errors
             try:
-                if line.endswith(b'\n'):
-                    line = line[:-1]
-            except:
-                l_errors.append(line)
-                continue
-            if args.spliter in line:
-                try:
-                    data = line.split(args.spliter, 1)
-                except:
-                    l_errors.append(line)
+                records = [(username, domain, secret.decode())
+                           for username, domain, secret in matches]
+            except UnicodeDecodeError:
+                return parse_lines(args, split_lines(block))
+            if args.cipher:
+                return [record + (args.hash_type,) for record in records], errors
+            return records, errors
+    return parse_lines(args, split_lines(block))
+
+
+def classify_records(records):
+    return [record + (normalize_hash_type(get_hash_type(record[2])),)
+            for record in records]
+
+
+EMAIL_COLUMNS = ['email', 'mail', 'e-mail', 'email_address', 'login', 'username', 'user']
+SECRET_COLUMNS = ['password', 'pass', 'passwd', 'pwd', 'hash', 'password_hash', 'secret']
+SALT_COLUMNS = ['salt', 'password_salt']
+
+
+def column_indexes(names):
+    """(email, secret, salt) indexes of a list of column names, None if unknown"""
+    names = [name.strip().strip(b'"`\'').lower().decode('latin-1') for name in names]
+
+    def find(candidates):
+        return next((names.index(name) for name in candidates if name in names), None)
+
+    email, secret = find(EMAIL_COLUMNS), find(SECRET_COLUMNS)
+    if email is None or secret is None:
+        return None
+    return email, secret, find(SALT_COLUMNS)
+
+
+def row_record(args, fields, columns=None):
+    """Record of a row of fields, from its known columns or from the first
+    field holding an email address and the one following it"""
+    if columns is not None and max(index for index in columns if index is not None) < len(fields):
+        email, secret, salt = columns
+    else:
+        email = next((i for i, field in enumerate(fields[:-1]) if b'@' in field), None)
+        if email is None:
+            return None
+        secret, salt = email + 1, None
+    data = fields[secret]
+    if salt is not None and fields[salt]:
+        data += b':' + fields[salt]
+    return email_record(args, fields[email], data)
+
+
+def parse_salted_block(args, block):
+    """email<sep>hash<sep>salt lines, secrets are stored as hash:salt"""
+    records = []
+    errors = []
+    for line in split_lines(block):
+        fields = line.split(args.spliter, 2)
+        record = None
+        if len(fields) == 3:
+            record = email_record(args, fields[0], fields[1] + b':' + fields[2])
+        if record is None:
+            errors.append(line)
+        else:
+            records.append(record)
+    return records, errors
+
+
+def parse_csv_block(args, block):
+    records = []
+    errors = []
+    # latin-1 maps every byte to a character and back, lines are split on
+    # newlines only as str.splitlines also splits on bytes like 0x85
+    delimiter = args.spliter.decode('latin-1')
+    lines = [line.decode('latin-1') for line in split_lines(block) if line.rstrip(b'\r') != args.header]
+    try:
+        rows = list(csv.reader(lines, delimiter=delimiter))
+    except csv.Error:
+        # an unbalanced quote swallows the following lines up to the field
+        # size limit, each line is then parsed alone
+        rows = []
+        for line in lines:
+            try:
+                rows.extend(csv.reader([line], delimiter=delimiter, strict=True))
+            except csv.Error:
+                errors.append(line.encode('latin-1'))
+    for row in rows:
+        fields = [field.encode('latin-1') for field in row]
+        record = row_record(args, fields, args.columns)
+        if record is None:
+            errors.append(args.spliter.join(fields))
+        else:
+            records.append(record)
+    return records, errors
+
+
+def json_value(value):
+    if value is None:
+        return b''
+    if isinstance(value, str):
+        return value.encode()
+    return str(value).encode()
+
+
+def parse_jsonl_block(args, block):
+    records = []
+    errors = []
+    for line in split_lines(block):
+        try:
+            document = json.loads(line)
+        except ValueError:
+            errors.append(line)
+            continue
+        record = None
+        if isinstance(document, dict):
+            keys = [key.encode() for key in document]
+            record = row_record(args, [json_value(value) for value in document.values()],
+                                column_indexes(keys))
+        if record is None:
+            errors.append(line)
+        else:
+            records.append(record)
+    return records, errors
+
+
+SQL_INSERT = re.compile(rb'^\s*INSERT\s+INTO\s+[^\s(]+\s*(?:\(([^)]*)\))?\s*VALUES\s*', re.IGNORECASE)
+SQL_TOKEN = re.compile(rb"\(|\)|'((?:[^'\\]|\\.|'')*)'|([^\s,()']+)", re.DOTALL)
+SQL_ESCAPE = re.compile(rb"\\(.)|''", re.DOTALL)
+SQL_ESCAPES = {b'0': b'\0', b'n': b'\n', b'r': b'\r', b't': b'\t', b'Z': b'\x1a'}
+
+
+def sql_unescape(match):
+    if match.group(1) is None:
+        return b"'"
+    return SQL_ESCAPES.get(match.group(1), match.group(1))
+
+
+def parse_sql_block(args, block):
+    """Rows of INSERT statements, every other line of the dump is ignored"""
+    records = []
+    errors = []
+    for line in split_lines(block):
+        insert = SQL_INSERT.match(line)
+        if insert is None:
+            continue
+        columns = None
+        if insert.group(1):
+            columns = column_indexes(insert.group(1).split(b','))
+        fields = None
+        for token in SQL_TOKEN.finditer(line, insert.end()):
+            if token.group(0) == b'(':
+                fields = []
+            elif token.group(0) == b')':
+                if fields is None:
                     continue
-                if len(data) == 2:
-                    if b'@' in data[0]:
-                        record = Record()
-                        record.set_username(data[0].split(b'@')[0])
-                        record.set_domain(data[0].split(b'@')[1])
-                        if args.hash or args.cipher:
-                            record.set_password_hash(data[1])
-                            if args.cipher:
-                                record.set_hash_type(args.cipher.lower())
-                            else:
-                                record.set_hash_type(
-                                    get_hash_type(record.hash))
-                            records.append(
-                                (record.username, record.domain, record.hash, record.hash_type))
-                        else:
-                            record.set_password(data[1])
-                            records.append(
-                                (record.username, record.domain, record.password))
-                    else:
-                        l_errors.append(line)
+                record = row_record(args, fields, columns)
+                if record is None:
+                    errors.append(b','.join(fields))
                 else:
-                    l_errors.append(line)
-            else:
-                l_errors.append(line)
-    try:
-        print('[*] Inserting {} records'.format(len(records)))
+                    records.append(record)
+                fields = None
+            elif fields is not None:
+                if token.group(1) is not None:
+                    fields.append(SQL_ESCAPE.sub(sql_unescape, token.group(1)))
+                elif token.group(2).upper() == b'NULL':
+                    fields.append(b'')
+                else:
+                    fields.append(token.group(2))
+    return records, errors
+
+
+PARSERS = {
+    'combo': parse_block,
+    'salted': parse_salted_block,
+    'csv': parse_csv_block,
+    'jsonl': parse_jsonl_block,
+    'sql': parse_sql_block,
+}
+SEPARATED_FORMATS = ['combo', 'salted', 'csv']
+SNIFF_SEPARATORS = [b':', b';', b',', b'\t', b'|', b' ']
+HEX_HASH = re.compile(rb'^[a-fA-F0-9]{16,}$')
+
+
+def sniff_format(sample):
+    """Returns the (format, separator) of the first lines of a file, format
+    being None when they look like none of the PARSERS"""
+    if b'\n' in sample:
+        sample = sample[:sample.rindex(b'\n')]
+    lines = [line.rstrip(b'\r') for line in split_lines(sample) if line.strip()]
+    if not lines:
+        return None, None
+    if sum(line.lstrip().startswith(b'{') for line in lines) * 2 > len(lines):
+        return 'jsonl', None
+    if any(SQL_INSERT.match(line) for line in lines):
+        return 'sql', None
+
+    def rows(separator):
+        return [line.split(separator) for line in lines
+                if any(b'@' in field for field in line.split(separator)[:-1])]
+
+    if b'@' not in lines[0] and len(lines) > 1:
+        # header line of a CSV file
+        lines = lines[1:]
+    separator = max(SNIFF_SEPARATORS, key=lambda separator: len(rows(separator)))
+    fields = rows(separator)
+    if len(fields) * 2 < len(lines):
+        return None, None
+    if (sum(b'"' in line for line in lines) * 10 > len(lines)
+            or sum(b'@' not in row[0] for row in fields) * 2 > len(fields)):
+        return 'csv', separator
+    if sum(len(row) >= 3 for row in fields) * 10 >= len(fields) * 9:
+        if sum(bool(HEX_HASH.match(row[1])) for row in fields) * 2 > len(fields):
+            return 'salted', separator
+        if len(separator) == 1 and separator in b',;\t|':
+            return 'csv', separator
+    return 'combo', separator
+
+
+def csv_header(sample):
+    """First line of a CSV sample, without its line ending"""
+    line = split_lines(sample[:sample.find(b'\n') + 1] or sample)
+    return line[0].rstrip(b'\r') if line else b''
+
+
+def csv_columns(sample, delimiter):
+    """Columns of the header line of a CSV sample, None without header"""
+    line = csv_header(sample)
+    if not line or b'@' in line:
+        return None
+    header = next(csv.reader([line.decode('latin-1')], delimiter=delimiter.decode('latin-1')))
+    return column_indexes([name.encode('latin-1') for name in header])
+
+
+def source_options(args, name, sample):
+    """Parsing options of an input file, None if its format is unknown"""
+    options = parse_options(args)
+    sniffed, separator = sniff_format(sample)
+    if args.format == 'auto':
+        options.format = 'combo' if args.spliter else sniffed
+    options.spliter = args.spliter or separator
+    if options.format is None:
+        print('[!] Unable to detect the format of {}, set it with --format and -s'.format(name))
+        return None
+    if options.format in SEPARATED_FORMATS and options.spliter is None:
+        print('[!] Unable to detect the separator of {}, set it with -s'.format(name))
+        return None
+    if options.format == 'csv':
+        if len(options.spliter) != 1:
+            print('[!] CSV separator of {} must be a single character'.format(name))
+            return None
+        options.columns = csv_columns(sample, options.spliter)
+        if options.columns is not None:
+            # the header line is skipped, not reported as an error
+            options.header = csv_header(sample)
+    if args.format == 'auto' or not args.spliter:
+        print('[*] Reading {} as {}{}'.format(name, options.format,
+                                              ' separated by {!r}'.format(options.spliter.decode('latin-1'))
+                                              if options.format in SEPARATED_FORMATS else ''))
+    return options
+
+
+def parse_timed_block(options, block, read_time=0.0):
+    """Parses a block and returns the chunk handled by the seeder:
+    records, errors, size and (read, parse, hash_type) busy seconds
+    """
+    started = time.perf_counter()
+    records, errors = PARSERS[options.format](options, block)
+    chunk = records, errors, len(block), (read_time, time.perf_counter() - started, 0.0)
+    if options.classify:
+        return classify_chunk(chunk)
+    return chunk
+
+
+def parse_chunk(options, path, start, end):
+    started = time.perf_counter()
+    block = read_chunk(path, start, end)
+    return parse_timed_block(options, block, time.perf_counter() - started)
+
+
+def classify_chunk(chunk):
+    records, errors, size, (read_time, parse_time, _) = chunk
+    started = time.perf_counter()
+    records = classify_records(records)
+    return records, errors, size, (read_time, parse_time, time.perf_counter() - started)
+
+
+async def pipeline_stage(inbox, outbox, work, concurrency):
+    """Moves the items of inbox to outbox through the work coroutine, running
+    at most concurrency of them at once.
+
+    Items are passed as futures in the inbox order, so the bounded outbox
+    limits the items in flight and holds back the previous stages when the
+    next ones are slower. None ends the stage.
+    """
+    running = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(item):
+        if asyncio.isfuture(item):
+            item = await item
+        async with running:
+            return await work(item)
+
+    while True:
+        item = await inbox.get()
+        if item is None:
+            await outbox.put(None)
+            return
+        await outbox.put(asyncio.ensure_future(run(item)))
+
+
+Source = collections.namedtuple('Source', ['name', 'stream', 'key', 'offset', 'compressed', 'size'])
+
+
+class Scheduler:
+    """Hands input sources out to the ingesting tasks, largest first so that
+    a huge file does not start last and keep a single task busy at the end.
+
+    At most decompress_jobs compressed sources are read at once, a task
+    waiting for one of them takes the next plain source meanwhile.
+    """
+
+    def __init__(self, sources, decompress_jobs):
+        self.pending = sorted(sources, key=lambda source: source.size - source.offset, reverse=True)
+        self.decompress_jobs = max(1, decompress_jobs)
+        self.decompressing = 0
+        self.changed = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.changed:
+            while self.pending:
+                for i, source in enumerate(self.pending):
+                    if not source.compressed or self.decompressing < self.decompress_jobs:
+                        del self.pending[i]
+                        self.decompressing += source.compressed
+                        return source
+                await self.changed.wait()
+        return None
+
+    async def release(self, source):
+        async with self.changed:
+            self.decompressing -= source.compressed
+            self.changed.notify_all()
+
+
+def ignore_sigint():
+    # parsing processes are stopped by the seeder, not by Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class MemoryBudget:
+    """Bytes of the records read and not committed yet, the batcher waits for
+    the writers to release some before adding a chunk which does not fit"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.released = asyncio.Condition()
+
+    def fits(self, size):
+        # a chunk larger than the ceiling still goes through alone
+        return not self.used or self.used + size <= self.limit
+
+    async def acquire(self, size):
+        async with self.released:
+            await self.released.wait_for(lambda: self.fits(size))
+            self.used += size
+
+    async def release(self, size):
+        async with self.released:
+            self.used -= size
+            self.released.notify_all()
+
+
+class BatchSizer:
+    """Batch size tuned toward a target commit latency.
+
+    Commit time is modeled as a fixed cost per batch plus a cost per record,
+    fitted on the last committed batches. The size moves toward the one which
+    would commit in target seconds, at most doubled or halved at once; it is
+    not shrunk when the fixed cost alone exceeds the target, smaller batches
+    would only lower the throughput. Batches of about the same size cannot
+    tell the fixed cost from the cost per record: their size is scaled toward
+    the target when they are fast, and halved when they are slow while no
+    fixed cost was fitted yet, which gives the fit a second size.
+    """
+
+    def __init__(self, size, target, minimum, maximum, stats=None):
+        self.size = size
+        self.target = target
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.stats = stats
+        self.samples = collections.deque(maxlen=16)
+        self.fixed = None
+
+    def wanted_size(self):
+        sizes = [nb_records for nb_records, _ in self.samples]
+        latencies = [seconds for _, seconds in self.samples]
+        mean_size = sum(sizes) / len(sizes)
+        mean_latency = sum(latencies) / len(latencies)
+        variance = sum((size - mean_size) ** 2 for size in sizes)
+        if (variance / len(sizes)) ** 0.5 * 10 < mean_size:
+            # scaling assumes no fixed cost: a fixed cost only makes the
+            # wanted size larger, but could be all of the latency
+            if mean_latency < self.target:
+                return int(mean_size * self.target / max(mean_latency, 1e-9))
+            if self.fixed is not None and self.fixed >= self.target:
+                return self.size
+            return self.size // 2
+        per_record = sum((size - mean_size) * (latency - mean_latency)
+                         for size, latency in self.samples) / variance
+        self.fixed = mean_latency - per_record * mean_size
+        if per_record <= 0:
+            # latency does not grow with the size, larger batches are free
+            return self.size * 2 if mean_latency < self.target else self.size
+        if self.fixed >= self.target:
+            return max(self.size, max(sizes))
+        return int((self.target - self.fixed) / per_record)
+
+    def update(self, nb_records, seconds):
+        if not self.target or not nb_records:
+            return
+        self.samples.append((nb_records, seconds))
+        size = max(self.size // 2, min(self.size * 2, self.wanted_size()))
+        size = max(self.minimum, min(self.maximum, size))
+        # small moves would only add noise to the logs
+        if abs(size - self.size) * 10 < self.size:
+            return
+        print('[*] Batch size {} -> {} ({} records committed in {:.2f}s)'.format(
+            self.size, size, nb_records, seconds))
+        self.size = size
+        if self.stats is not None:
+            self.stats.batch_sizes.append((round(self.stats.elapsed(), 1), size))
+
+
+async def writer(pool, args, queue, checkpoint, stats, sizer, budget):
+    copy = BinaryCopy() if args.copy_format == 'binary' else None
+    while True:
+        batch = await queue.get()
+        if batch is None:
+            queue.task_done()
+            return
+        batch_id, records, size = batch
+        started = time.perf_counter()
+        async with pool.acquire() as connection:
+            rows = await insert_batch(connection, args, records, copy)
+        seconds = time.perf_counter() - started
+        stats.add_batch(rows, seconds)
+        if rows is not None:
+            sizer.update(len(records), seconds)
+        checkpoint.commit(batch_id, rows is not None)
+        await budget.release(size)
+        queue.task_done()
+
+
+async def report_stats(args, stats, queue):
+    while True:
+        await asyncio.sleep(args.stats_interval)
+        stats.sample_queue(queue)
+        stats.report()
+
+
+async def count_writers(args):
+    if args.writers:
+        return args.writers
+    connection = await async_db_connect()
+    if not connection:
+        return 1
+    available = await select_available_connections(connection)
+    await connection.close()
+    return max(1, min(MAX_WRITERS, available // 2))
+
+
+async def insert_in_db(args, errors=None, stats=None, deduplicated=None):
+    """Loads the input files, errors and stats are those of the dedup pass
+    which produced the deduplicated file when --dedup is used"""
+    writers = 0 if args.dry_run else await count_writers(args)
+    pool = None
+    if writers:
+        pool = await async_db_pool(writers)
+    # queued batches are bounded by the memory budget, not by their number
+    queue = asyncio.Queue()
+    budget = MemoryBudget(args.max_memory * 1024 * 1024)
+    # a dry run may start from the journal offsets but never moves them
+    checkpoint = Checkpoint(None if args.dry_run else args.checkpoint,
+                            read_journal(args.checkpoint) if args.resume else None)
+    if stats is None:
+        stats = Stats()
+    if args.dry_run:
+        stats.projection = Projection()
+    sizer = BatchSizer(args.batch_size, args.target_latency,
+                       args.min_batch_size, args.max_batch_size, stats)
+    tasks = [asyncio.ensure_future(writer(pool, args, queue, checkpoint, stats, sizer, budget))
+             for _ in range(writers)]
+    reporter = None
+    if args.stats_interval > 0:
+        reporter = asyncio.ensure_future(report_stats(args, stats, queue))
+    known_hash_types = {}
+    domains = DomainCache()
+    if pool:
+        async with pool.acquire() as connection:
+            await domains.load(connection)
+    if errors is None:
+        errors = ErrorWriter()
+    records = []
+    records_size = 0
+    batch_id = 0
+    executor = None
+    if args.jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(args.jobs, initializer=ignore_sigint)
+    classify_executor = None
+    if args.classify_jobs > 1:
+        classify_executor = concurrent.futures.ProcessPoolExecutor(args.classify_jobs, initializer=ignore_sigint)
+    loop = asyncio.get_event_loop()
+
+    stopping = asyncio.Event()
+
+    def stop():
+        if stopping.is_set():
+            signal_handler(signal.SIGINT, None)
+        print('[-] Stopping, flushing pending records (Ctrl-C again to abort)')
+        stopping.set()
+
+    asyncio.get_event_loop().add_signal_handler(signal.SIGINT, stop)
+
+    def reject(records):
+        for record in records:
+            errors.write(record_line(record, args.spliter or b':'))
+        stats.errors += len(records)
+
+    async def prepare_hash_types(hash_types):
+        """Hash types whose table is ready, the missing ones being created
+        once the writers have committed: the DDL locks rotulus.records"""
+        missing = [hash_type for hash_type in hash_types if hash_type not in known_hash_types]
+        if missing:
+            await queue.join()
+            for hash_type in missing:
+                if not await loop.run_in_executor(None, prepare_hash_type, hash_type, known_hash_types):
+                    print('[!] Unable to create the table of {} hashes'.format(hash_type))
+        return [hash_type for hash_type in hash_types if hash_type in known_hash_types]
+
+    async def flush(batch, size):
+        """Queues the batch, its size in bytes being released from the budget
+        by the writers, or right away for the records which are not loaded"""
+        nonlocal batch_id
+        count = len(batch)
+        if args.hash and not args.cipher:
+            # secrets hashid cannot identify are not hashes
+            unknown = [record for record in batch if record[3] == 'error']
+            if unknown:
+                reject(unknown)
+                batch = [record for record in batch if record[3] != 'error']
+        if args.dry_run:
+            stats.projection.add(batch)
+            await budget.release(size)
+            batch_id += 1
+            return
+        failed = []
         if args.hash or args.cipher:
-            await add_records_with_hashes(connection, records)
+            # one batch per hash type, loaded concurrently in their own tables
+            groups = group_by_hash_type(batch)
+            prepared = await prepare_hash_types(list(groups))
+            for hash_type in list(groups):
+                if hash_type not in prepared:
+                    failed.append(groups.pop(hash_type))
+                elif known_hash_types[hash_type] == 'bytea':
+                    groups[hash_type], salted, bad = digest_records(groups[hash_type])
+                    reject(bad)
+                    if salted and await prepare_hash_types([salted[0][3]]):
+                        groups[salted[0][3]].extend(salted)
+                    elif salted:
+                        failed.append(salted)
+            groups = {hash_type: group for hash_type, group in groups.items() if group}
         else:
-            await insert_records_with_passwords(connection, records)
-    except Exception as e:
-        print('[!] Error while inserting data to PostgreSQL:\n\t{}'.format(e))
+            groups = {None: batch}
+        async with pool.acquire() as connection:
+            for hash_type in groups:
+                groups[hash_type] = await domains.replace_domains(connection, groups[hash_type])
+        for group in groups.values():
+            checkpoint.add_part(batch_id)
+        for group in failed:
+            print('[!] {} records of {} hashes not loaded'.format(len(group), group[0][3]))
+            stats.add_batch(None, 0.0)
+            checkpoint.add_part(batch_id)
+            checkpoint.commit(batch_id, False)
+        if not groups and not failed:
+            # every record was rejected, nothing to wait for
+            checkpoint.add_part(batch_id)
+            checkpoint.commit(batch_id)
+        sizes = {hash_type: size * len(group) // count for hash_type, group in groups.items()}
+        await budget.release(size - sum(sizes.values()))
+        for hash_type, group in groups.items():
+            await queue.put((batch_id, group, sizes[hash_type]))
+        batch_id += 1
+
+    block_size = args.chunk_size * 1024 * 1024
+    sources = []
+    for file in args.file:
+        for name, stream, compressed, size in open_sources(file):
+            key = file_key(name)
+            sources.append(Source(name, stream, key, checkpoint.offset(key),
+                                  compressed or not mappable(stream), size))
+    scheduler = Scheduler(sources, args.decompress_jobs)
+
+    async def add_chunk(source, offset, chunk_records, chunk_errors, chunk_size):
+        nonlocal records, records_size
+        for line in chunk_errors:
+            errors.write(line)
+        chunk_bytes = chunk_size + len(chunk_records) * RECORD_OVERHEAD
+        if records and not budget.fits(chunk_bytes):
+            # only the writers can release memory, give them the pending records
+            await flush(records, records_size)
+            records = []
+            records_size = 0
+        await budget.acquire(chunk_bytes)
+        records.extend(chunk_records)
+        records_size += chunk_bytes
+        while len(records) >= sizer.size:
+            batch_size = sizer.size
+            remaining = records_size * (len(records) - batch_size) // len(records)
+            await flush(records[:batch_size], records_size - remaining)
+            del records[:batch_size]
+            records_size = remaining
+        # records read up to offset are in the batch being filled, or
+        # in the last queued one when it is empty
+        checkpoint.mark(source.key, offset, batch_id if records else batch_id - 1)
+
+    # reader -> parser -> classifier -> batcher -> writers, every stage
+    # holding at most queue_size chunks, or the number of its jobs
+    read = asyncio.Queue(max(1, args.queue_size))
+    parsed = asyncio.Queue(max(args.queue_size, args.jobs * 2))
+    classified = asyncio.Queue(max(args.queue_size, args.classify_jobs * 2))
 
-    after = await select_record_count(connection)
+    async def read_source(source):
+        offset = source.offset
+        if offset:
+            print('[*] Resuming {} from byte {}'.format(source.name, offset))
+        sniff_size = args.sniff_size * 1024
+        if source.compressed:
+            blocks = prefetch(read_blocks(source.stream, block_size, offset), PREFETCH_DEPTH)
+            first = await loop.run_in_executor(None, next, blocks, b'')
+            sample = first[:sniff_size]
+            blocks = itertools.chain([first], blocks)
+        else:
+            sample = read_chunk(source.stream.name, 0, min(sniff_size, source.size))
+        options = source_options(args, source.name, sample)
+        if options is None:
+            return
+        if source.name != deduplicated:
+            stats.add_file(source.name, 0, 0)
+        if not source.compressed and executor:
+            # byte ranges, read by the parsing processes themselves
+            for start, end in file_chunks(source.stream.name, block_size, offset):
+                if stopping.is_set():
+                    return
+                await read.put((source, options, end, ('range', start, end)))
+            return
+        if not source.compressed:
+            blocks = file_blocks(source.stream, block_size, offset)
+        while not stopping.is_set():
+            # blocks may come from a decompressing thread, wait for them in a thread too
+            started = time.perf_counter()
+            block = await loop.run_in_executor(None, next, blocks, None)
+            if block is None:
+                return
+            offset += len(block)
+            await read.put((source, options, offset, ('block', block, time.perf_counter() - started)))
 
-    if l_errors:
-        write_errors(l_errors)
+    async def read_sources():
+        while True:
+            source = await scheduler.acquire()
+            if source is None:
+                return
+            try:
+                if not stopping.is_set():
+                    await read_source(source)
+            except READ_ERRORS as e:
+                # blocks read before the error are still loaded
+                print('[!] Unable to read {}: {}'.format(source.name, e))
+                stats.add_file_failure(source.name, e)
+            finally:
+                await scheduler.release(source)
 
-    print('[-] SUCCESS={} ERROR={}'.format(after-before, len(l_errors)))
+    async def reader():
+        try:
+            await asyncio.gather(*[read_sources() for _ in range(max(1, args.file_jobs))])
+        finally:
+            await read.put(None)
+
+    async def parse(item):
+        source, options, offset, payload = item
+        if payload[0] == 'range':
+            chunk = await loop.run_in_executor(executor, parse_chunk, options,
+                                               source.stream.name, payload[1], payload[2])
+        else:
+            chunk = await loop.run_in_executor(executor, parse_timed_block, options, payload[1], payload[2])
+        return source, options, offset, chunk
+
+    async def classify(item):
+        source, options, offset, chunk = item
+        if options.hash and not options.cipher and not options.classify:
+            chunk = await loop.run_in_executor(classify_executor, classify_chunk, chunk)
+        return source, options, offset, chunk
+
+    stages = [asyncio.ensure_future(reader()),
+              asyncio.ensure_future(pipeline_stage(read, parsed, parse, args.jobs)),
+              asyncio.ensure_future(pipeline_stage(parsed, classified, classify, args.classify_jobs))]
+    while True:
+        item = await classified.get()
+        if item is None:
+            break
+        source, options, offset, (chunk_records, chunk_errors, chunk_size, timings) = await item
+        nb_lines = len(chunk_records) + len(chunk_errors)
+        if source.name == deduplicated:
+            # lines and bytes were counted for each input by the dedup pass
+            stats.add_chunk(0, len(chunk_errors), 0, timings)
+        else:
+            stats.add_chunk(nb_lines, len(chunk_errors), chunk_size, timings)
+            stats.add_file(source.name, nb_lines, len(chunk_errors))
+        stats.sample_queue(queue)
+        await add_chunk(source, offset, chunk_records, chunk_errors, chunk_size)
+    await asyncio.gather(*stages)
+    if records:
+        await flush(records, records_size)
+    for _ in tasks:
+        await queue.put(None)
+    await asyncio.gather(*tasks)
+    for process_pool in (executor, classify_executor):
+        if process_pool:
+            process_pool.shutdown(cancel_futures=True)
+    if reporter:
+        reporter.cancel()
+    if pool:
+        await pool.close()
+
+    errors.close()
+
+    stats.print_summary()
+    stats.print_files()
+    if args.stats_json:
+        stats.write_json(args.stats_json)
+    if args.dry_run:
+        print('[-] DRY RUN RECORDS={} ERROR={}'.format(stats.projection.records, errors.count))
+    else:
+        print('[-] SUCCESS={} ERROR={}'.format(stats.rows, errors.count))
+    if stopping.is_set() and not args.dry_run:
+        print('[*] Run again with --resume to continue from the last committed batch')
+
+
+def dedup_inputs(args, errors, stats):
+    """Parses every input file and writes their distinct (email, secret)
+    pairs, emails lowercased, in a temporary combo file which replaces them.
+    Lines and errors of each input are counted in stats. Returns its path.
+    """
+    spliter = args.spliter or b':'
+    block_size = args.chunk_size * 1024 * 1024
+    sniff_size = args.sniff_size * 1024
+    sorter = ExternalSort(args.dedup_memory * 1024 * 1024, args.tmp_dir)
+    try:
+        for file in args.file:
+            for name, stream, _, _ in open_sources(file):
+                blocks = read_blocks(stream, block_size)
+                first = next(blocks, b'')
+                options = source_options(args, name, first[:sniff_size])
+                if options is None:
+                    continue
+                for block in itertools.chain([first], blocks):
+                    records, block_errors = PARSERS[options.format](options, block)
+                    for line in block_errors:
+                        errors.write(line)
+                    nb_errors = len(block_errors)
+                    for record in records:
+                        secret = record[2].encode() if isinstance(record[2], str) else record[2]
+                        email = (record[0] + b'@' + record[1]).lower()
+                        if spliter in email or b'\n' in secret:
+                            errors.write(email + spliter + secret)
+                            nb_errors += 1
+                            continue
+                        sorter.add(email + spliter + secret)
+                    nb_lines = len(records) + len(block_errors)
+                    stats.add_chunk(nb_lines, nb_errors, len(block), ())
+                    stats.add_file(name, nb_lines, nb_errors)
+        output, path = tempfile.mkstemp(prefix='rotulus_dedup_', suffix='.txt', dir=args.tmp_dir)
+        os.close(output)
+        sorter.write(path)
+    finally:
+        sorter.close()
+    args.file = [open(path, 'rb')]
+    args.spliter = spliter
+    args.format = 'combo'
+    return path
 
 
 def main():
     signal.signal(signal.SIGINT, signal_handler)
-    asyncio.get_event_loop().run_until_complete(insert_in_db(parse_cli()))
+    args = parse_cli()
+    deduplicated = None
+    # one error file and one count for both passes of --dedup
+    errors = ErrorWriter()
+    stats = Stats()
+    if args.dedup:
+        if args.resume:
+            print('[!] --resume is not supported with --dedup, files are loaded from the beginning')
+            args.resume = False
+        deduplicated = dedup_inputs(args, errors, stats)
+    defer_constraints = args.defer_constraints and not args.dry_run
+    if defer_constraints and not begin_bulk_load():
+        return
+    try:
+        asyncio.get_event_loop().run_until_complete(insert_in_db(args, errors, stats, deduplicated))
+    finally:
+        if defer_constraints and not end_bulk_load(args.index_jobs, args.maintenance_work_mem):
+            print("[!] Bulk load mode is still enabled, run 'rotulus database -d bulk-end -j {} -m {}'".format(
+                args.index_jobs, args.maintenance_work_mem))
+    if deduplicated:
+        os.remove(deduplicated)
 
 
 if __name__ == '__main__':
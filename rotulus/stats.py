@@ -0,0 +1,201 @@
+import collections
+import json
+import math
+import time
+
+STAGES = ['read', 'parse', 'hash_type', 'write']
+
+
+class Stats:
+    """Throughput counters of the seeder pipeline.
+
+    Stage times are busy seconds summed over every worker of the stage, so
+    with parallel parsers or writers they can exceed the elapsed time.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.lines = 0
+        self.bytes = 0
+        self.errors = 0
+        self.rows = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.files = {}
+        self.projection = None
+        self.batch_sizes = []
+        self.last = (self.started, 0, 0, 0)
+
+    def add_chunk(self, nb_lines, nb_errors, size, timings):
+        self.lines += nb_lines
+        self.errors += nb_errors
+        self.bytes += size
+        for stage, seconds in zip(STAGES, timings):
+            self.stages[stage] += seconds
+
+    def add_batch(self, rows, seconds):
+        self.stages['write'] += seconds
+        if rows is None:
+            self.failed_batches += 1
+        else:
+            self.batches += 1
+            self.rows += rows
+
+    def add_file(self, name, nb_lines, nb_errors):
+        counts = self.files.setdefault(name, {'lines': 0, 'errors': 0})
+        counts['lines'] += nb_lines
+        counts['errors'] += nb_errors
+
+    def add_file_failure(self, name, error):
+        self.add_file(name, 0, 0)
+        self.files[name]['failure'] = str(error)
+
+    def sample_queue(self, queue):
+        self.queue_depth = queue.qsize()
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def report(self):
+        now = time.perf_counter()
+        last_time, last_lines, last_bytes, last_rows = self.last
+        seconds = max(now - last_time, 1e-9)
+        print('[*] {} lines ({:.0f} lines/s, {:.1f} MB/s), {} rows committed ({:.0f} rows/s), '
+              'queue {}, errors {}'.format(self.lines,
+                                           (self.lines - last_lines) / seconds,
+                                           (self.bytes - last_bytes) / seconds / 1024 / 1024,
+                                           self.rows,
+                                           (self.rows - last_rows) / seconds,
+                                           self.queue_depth,
+                                           self.errors))
+        self.last = (now, self.lines, self.bytes, self.rows)
+
+    def summary(self):
+        elapsed = max(self.elapsed(), 1e-9)
+        summary = {
+            'elapsed': elapsed,
+            'lines': self.lines,
+            'bytes': self.bytes,
+            'errors': self.errors,
+            'rows': self.rows,
+            'batches': self.batches,
+            'failed_batches': self.failed_batches,
+            'lines_per_second': self.lines / elapsed,
+            'bytes_per_second': self.bytes / elapsed,
+            'rows_per_second': self.rows / elapsed,
+            'max_queue_depth': self.max_queue_depth,
+            'stages': dict(self.stages),
+            'files': dict(self.files),
+            'batch_sizes': list(self.batch_sizes),
+        }
+        if self.projection is not None:
+            summary['error_rate'] = self.errors / max(self.lines, 1)
+            summary['projection'] = self.projection.summary()
+        return summary
+
+    def print_summary(self):
+        summary = self.summary()
+        print('[*] {} lines in {:.1f}s ({:.0f} lines/s, {:.1f} MB/s), {} rows committed ({:.0f} rows/s)'.format(
+            summary['lines'], summary['elapsed'], summary['lines_per_second'],
+            summary['bytes_per_second'] / 1024 / 1024, summary['rows'], summary['rows_per_second']))
+        print('[*] Busy time: {}'.format(', '.join('{} {:.1f}s'.format(stage, seconds)
+                                                   for stage, seconds in self.stages.items())))
+        if self.projection is not None:
+            print('[*] Error rate: {:.2f}% ({} of {} lines)'.format(
+                summary['error_rate'] * 100, self.errors, self.lines))
+            self.projection.print_summary()
+
+    def print_files(self):
+        for name, counts in self.files.items():
+            if 'failure' in counts:
+                print('[!] {}: {} lines, {} errors, read failed: {}'.format(
+                    name, counts['lines'], counts['errors'], counts['failure']))
+            else:
+                print('[*] {}: {} lines, {} errors'.format(name, counts['lines'], counts['errors']))
+
+    def write_json(self, path):
+        try:
+            with open(path, 'w') as summary_file:
+                json.dump(self.summary(), summary_file, indent=2)
+            print('[+] Statistics writed to {}'.format(path))
+        except OSError as e:
+            print('[!] Unable to write statistics to {}: {}'.format(path, e))
+
+
+class HyperLogLog:
+    """Approximate count of distinct values in 2 ** precision bytes,
+    with a standard error of about 1.04 / sqrt(2 ** precision)"""
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+        self.width = 64 - precision
+        self.mask = (1 << self.width) - 1
+
+    def add(self, value):
+        # hash() of bytes and str is a 64 bits SipHash, stable within a process
+        hashed = hash(value) & 0xFFFFFFFFFFFFFFFF
+        index = hashed >> self.width
+        rank = self.width - (hashed & self.mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def count(self):
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = size * math.log(size / zeros)
+        return int(round(estimate))
+
+
+class Projection:
+    """Rows a load would add to every table, distinct values being estimated"""
+
+    def __init__(self):
+        self.records = 0
+        self.usernames = HyperLogLog()
+        self.domains = HyperLogLog()
+        self.secrets = collections.defaultdict(HyperLogLog)
+        self.hash_types = collections.Counter()
+
+    def add(self, records):
+        self.records += len(records)
+        self.usernames.update(record[0] for record in records)
+        self.domains.update(record[1] for record in records)
+        for record in records:
+            hash_type = record[3] if len(record) > 3 else None
+            self.hash_types[hash_type] += 1
+            self.secrets['{}_hashes'.format(hash_type) if hash_type else 'passwords'].add(record[2])
+
+    def tables(self):
+        tables = {'records': self.records,
+                  'usernames': self.usernames.count(),
+                  'domains': self.domains.count()}
+        for table, secrets in sorted(self.secrets.items()):
+            tables[table] = secrets.count()
+        return tables
+
+    def summary(self):
+        return {'tables': self.tables(),
+                'hash_types': {hash_type or 'clear': count
+                               for hash_type, count in self.hash_types.most_common()}}
+
+    def print_summary(self):
+        summary = self.summary()
+        if self.records:
+            print('[*] Hash types: {}'.format(', '.join(
+                '{} {} ({:.1f}%)'.format(hash_type, count, count * 100 / self.records)
+                for hash_type, count in summary['hash_types'].items())))
+        print('[*] Projected rows: {}'.format(', '.join(
+            '{} {}'.format(table, rows) for table, rows in summary['tables'].items())))
@@ -1,8 +1,10 @@
 import argparse
+import concurrent.futures
 import signal
 import sys
 
-from rotulus.database import db_connect, execute_query
+from rotulus.database import (close_communication, db_connect, execute_query, select_hash_columns,
+                              select_partitions)
 from rotulus.query import get_hash_types
 
 
@@ -16,63 +18,84 @@ def parse_cli():
                         help='Find clear password of a hashes')
     parser.add_argument('-a', '--hash', action='store_true',
                         help='Hash all passwords using hash types present in database')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Number of partitions of rotulus.records updated at once (default: 4)')
     args = parser.parse_args()
 
     if args.find:
-        associate_hash_to_clear()
+        associate_hash_to_clear(args.jobs)
     elif args.hash:
-        hash_all_passwords()
+        hash_all_passwords(args.jobs)
 
 
-def associate_hash_to_clear():
+def update_partitions(queries, jobs):
+    """Runs every query in its own connection, jobs at once"""
+    def run(query):
+        connection = db_connect()
+        if connection == False:
+            return False
+        try:
+            return execute_query(connection, query)
+        finally:
+            close_communication(connection)
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        return all(executor.map(run, queries))
+
+
+def associate_hash_to_clear(jobs=4):
     connection = db_connect()
     if connection != False:
-        hash_types = get_hash_types(connection)
-        for hash_type in hash_types:
-            query = 'with ins1 as ( \
-                select distinct password_id, {}_id \
+        partitions = select_partitions(connection)
+        for hash_type, in get_hash_types(connection):
+            # a single clear password per hash, joined by every partition;
+            # the table of an interrupted run is dropped first
+            query = 'drop table if exists rotulus.{0}_clear; \
+                create unlogged table rotulus.{0}_clear as \
+                select distinct on ({0}_id) {0}_id as hash_id, password_id \
                 from rotulus.records \
-                where password_id is not null and {}_id is not null) \
-                update rotulus.records r \
-                set password_id = ( \
-                    select password_id from ins1 \
-                    where {}_id = r.{}_id) \
-                where password_id is null'.format(hash_type, hash_type, hash_type, hash_type)
-            execute_query(connection, query)
+                where password_id is not null and {0}_id is not null'.format(hash_type)
+            if execute_query(connection, query) == False:
+                continue
+            execute_query(connection, 'create index on rotulus.{}_clear (hash_id)'.format(hash_type))
+            update_partitions(['update {} r \
+                set password_id = c.password_id \
+                from rotulus.{}_clear c \
+                where r.password_id is null and r.{}_id = c.hash_id'.format(
+                partition, hash_type, hash_type) for partition in partitions], jobs)
+            execute_query(connection, 'drop table rotulus.{}_clear'.format(hash_type))
             print("[*] {} hashes has been associated with their clear".format(hash_type.upper()))
-
-
-def passwords_not_hashed(connection, hash_type):
-    cur = connection.cursor()
-    query = 'select id from rotulus.records where {}_id is null'.format(hash_type)
-    cur.execute(query)
-    return cur.fetchone()
-
-
-def hash_passwords_to_md5(connection):
-    query = 'with ins1 as ( \
-        insert into rotulus.md5_hashes (hash) \
-        select md5(password) from rotulus.passwords p \
-        inner join rotulus.records r on p.id = r.password_id \
-            where r.md5_id is null limit 1 \
-        on conflict (hash) do update set hash=excluded.hash returning id as hash_id) \
-        update rotulus.records \
-        set md5_id = (select hash_id from ins1) \
-            where id = (select id from rotulus.records where md5_id is null limit 1)'
-    while passwords_not_hashed(connection, 'md5') != None:
-        execute_query(connection, query)
-
-
-def hash_all_passwords():
+        close_communication(connection)
+
+
+def hash_passwords_to_md5(partitions, jobs, column_type='text'):
+    # binary digest tables hold the decoded md5
+    md5 = "decode(md5(p.password), 'hex')" if column_type == 'bytea' else 'md5(p.password)'
+    update_partitions(['insert into rotulus.md5_hashes (hash) \
+        select distinct {} from rotulus.passwords p \
+        inner join {} r on p.id = r.password_id \
+            where r.md5_id is null \
+        order by 1 \
+        on conflict (hash) do nothing'.format(md5, partition) for partition in partitions], jobs)
+    return update_partitions(['update {} r \
+        set md5_id = h.id \
+        from rotulus.passwords p, rotulus.md5_hashes h \
+        where r.md5_id is null and p.id = r.password_id and h.hash = {}'.format(
+        partition, md5) for partition in partitions], jobs)
+
+
+def hash_all_passwords(jobs=4):
     connection = db_connect()
     if connection != False:
-        hash_types = get_hash_types(connection)
-        for hash_type in hash_types:
-            if hash_type[0] == 'md5':
-                hash_passwords_to_md5(connection)
-                print("[*] All passwords has been hashes to MD5")
+        partitions = select_partitions(connection)
+        hash_columns = select_hash_columns(connection)
+        for hash_type, in get_hash_types(connection):
+            if hash_type == 'md5':
+                if hash_passwords_to_md5(partitions, jobs, hash_columns.get(hash_type)):
+                    print("[*] All passwords has been hashes to MD5")
             else:
-                print("[*] Issue a ticket to implement {}".format(hash_type.upper())) 
+                print("[*] Issue a ticket to implement {}".format(hash_type.upper()))
+        close_communication(connection)
 
 
 def main():